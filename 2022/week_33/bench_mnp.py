@@ -0,0 +1,203 @@
+"""
+Benchmarks for the MSM estimation of the MNP model.
+
+Run all benchmarks with `python bench_mnp.py`, or a single one with e.g.
+`python bench_mnp.py startup`.
+"""
+import os
+import subprocess
+import sys
+import time
+
+import numba
+import numpy as np
+import mnp_utils
+
+
+def best_time(f, repeat=3):
+    """Best wall time of `repeat` calls of f() (after one warm-up call), and f's result."""
+    result = f()
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        result = f()
+        times.append(time.perf_counter() - t0)
+    return min(times), result
+
+
+def data(N, m, b=4.0, seed=1688):
+    """Data set of the notebook (attributes uniform on [0, 10])."""
+    return mnp_utils.dgp(b, N, m, 0.0, 10.0, seed)
+
+
+def bench_stern(N=10_000, m=5, S=5, seed=42):
+    """Before/after: criterion evaluation with stern_sim vs stern_sim_factored (factors precomputed)."""
+    Z, Y = data(N, m)
+    V = np.random.default_rng(seed).normal(0, 1, (N, S, m, m - 1))
+    args = (Z, Y, mnp_utils.simple_iv, mnp_utils.mom)
+    t_factors, Z_sim = best_time(lambda: mnp_utils.stern_factors(Z), repeat=1)
+    t_before, c_before = best_time(
+        lambda: mnp_utils.msm_criteria(4.0, *args, mnp_utils.stern_sim, V, S)
+    )
+    t_after, c_after = best_time(
+        lambda: mnp_utils.msm_criteria(4.0, *args, mnp_utils.stern_sim_factored, V, S, None, Z_sim)
+    )
+    print(f"stern criterion (N={N}, m={m}, S={S}):")
+    print(f"  before: {t_before:8.3f} s")
+    print(f"  after:  {t_after:8.3f} s  ({t_before / t_after:.1f}x), factors once {t_factors:.3f} s")
+    print(f"  relative difference {abs(c_after - c_before) / abs(c_before):.2e}")
+
+
+STARTUP = """
+import sys, time
+t0 = time.perf_counter()
+import mnp_utils
+t1 = time.perf_counter()
+heavy = [m for m in ("matplotlib", "scipy.optimize", "scipy.stats") if m in sys.modules]
+import numpy as np
+Z, Y = mnp_utils.dgp(0.5, 100, 3)
+t2 = time.perf_counter()
+V = np.random.normal(0, 1, (100, 5, 3, 2))
+mnp_utils.msm_criteria(
+    0.5, Z, Y, mnp_utils.simple_iv, mnp_utils.mom, mnp_utils.stern_sim, V, 5, None
+)
+print(t1 - t0, t2 - t1, time.perf_counter() - t2, ",".join(heavy))
+"""
+
+
+def bench_startup(repeat=2):
+    """Import, first dgp call and first criterion call in fresh processes.
+
+    The first run may compile and populate numba's disk cache; later runs load
+    from it. Raises AssertionError if importing mnp_utils imports scipy.optimize,
+    scipy.stats or matplotlib.
+    """
+    print("startup (fresh process):")
+    for i in range(repeat):
+        out = subprocess.run(
+            [sys.executable, "-c", STARTUP],
+            cwd=os.path.dirname(os.path.abspath(__file__)),
+            capture_output=True,
+            text=True,
+            check=True,
+        ).stdout.split()
+        assert len(out) == 3, f"importing mnp_utils imports {out[3]}"
+        t_import, t_dgp, t_criteria = map(float, out)
+        print(
+            f"  run {i + 1}: import {t_import:6.3f} s, dgp {t_dgp:6.3f} s, "
+            f"msm_criteria {t_criteria:6.3f} s"
+        )
+
+
+def bench_importance(N=10_000, m=5, S=5, seed=42):
+    """Before/after: criterion evaluation with imp_sim vs imp_sim_chol (Cholesky factors precomputed).
+
+    The two differ by design: imp_sim_chol weights each alternative by the density of its own draws.
+    """
+    Z, Y = data(N, m)
+    V = np.random.default_rng(seed).exponential(1, (N, S, m, m - 1))
+    args = (Z, Y, mnp_utils.simple_iv, mnp_utils.mom)
+    t_factors, Z_sim = best_time(lambda: mnp_utils.imp_factors(Z), repeat=1)
+    t_before, c_before = best_time(
+        lambda: mnp_utils.msm_criteria(4.0, *args, mnp_utils.imp_sim, V, S)
+    )
+    t_after, c_after = best_time(
+        lambda: mnp_utils.msm_criteria(4.0, *args, mnp_utils.imp_sim_chol, V, S, None, Z_sim)
+    )
+    print(f"importance criterion (N={N}, m={m}, S={S}):")
+    print(f"  before: {t_before:8.3f} s")
+    print(f"  after:  {t_after:8.3f} s  ({t_before / t_after:.1f}x), factors once {t_factors:.3f} s")
+    print(f"  relative difference {abs(c_after - c_before) / abs(c_before):.2e}")
+
+
+def bench_criteria(N=100_000, m=5, S=10, seed=42):
+    """Before/after: msm_criteria vs the parallel engine make_msm_criteria (stern_sim_factored),
+    from 1 to NUMBA_NUM_THREADS threads.
+    """
+    Z, Y = data(N, m)
+    V = np.random.default_rng(seed).normal(0, 1, (N, S, m, m - 1))
+    Z_sim = mnp_utils.stern_factors(Z)
+    args = (Z, Y, mnp_utils.simple_iv, mnp_utils.mom)
+    t_before, c_before = best_time(
+        lambda: mnp_utils.msm_criteria(
+            4.0, *args, mnp_utils.stern_sim_factored, V, S, None, Z_sim
+        )
+    )
+    t_setup, criteria = best_time(
+        lambda: mnp_utils.make_msm_criteria(
+            *args, mnp_utils.stern_sim_factored_into, V, S, None, Z_sim
+        ),
+        repeat=1,
+    )
+    print(f"criteria (N={N}, m={m}, S={S}):")
+    print(f"  before:      {t_before:8.3f} s")
+    n_max = numba.config.NUMBA_NUM_THREADS
+    for n in sorted({2**k for k in range(n_max.bit_length()) if 2**k <= n_max} | {n_max}):
+        numba.set_num_threads(n)
+        t, c = best_time(lambda: criteria(4.0))
+        print(f"  {n:3d} threads: {t:8.3f} s  ({t_before / t:.1f}x)")
+    numba.set_num_threads(n_max)
+    print(f"  setup once {t_setup:.3f} s, relative difference {abs(c - c_before) / c_before:.2e}")
+
+
+def bench_counter_draws(N=100_000, m=5, S=10, seed=42):
+    """Before/after: stern criteria on stored draws V vs Philox draws made in the kernel."""
+    Z, Y = data(N, m)
+    Z_sim = mnp_utils.stern_factors(Z)
+    args = (Z, Y, mnp_utils.simple_iv, mnp_utils.mom, mnp_utils.stern_sim_factored_into)
+    t_draw, V = best_time(lambda: np.random.normal(0, 1, (N, S, m, m - 1)), repeat=1)
+    stored = mnp_utils.make_msm_criteria(*args, V, S, None, Z_sim)
+    counter = mnp_utils.make_msm_criteria(
+        *args, None, S, None, Z_sim,
+        draw_into=mnp_utils.normal_draws_into, seed=seed, draw_shape=(m, m - 1),
+    )
+    t_before, _ = best_time(lambda: stored(4.0))
+    t_after, _ = best_time(lambda: counter(4.0))
+    print(f"counter draws (N={N}, m={m}, S={S}):")
+    print(f"  stored:  {t_before:8.3f} s per criteria, V {V.nbytes / 2**20:8.1f} MiB drawn in {t_draw:.3f} s")
+    print(f"  counter: {t_after:8.3f} s per criteria, no stored draws")
+
+
+def bench_ghk(N=10_000, m=5, S=(1, 5), reps=5):
+    """Stern (numerical gradient) vs GHK (analytic gradient) estimates with BFGS.
+
+    The spread of b over `reps` draw seeds on the same data is the simulation noise.
+    """
+    Z, Y = data(N, m)
+    args = (Z, Y, mnp_utils.simple_iv, mnp_utils.mom)
+    runs = {
+        "stern_factored": dict(simulator=mnp_utils.stern_sim_factored),
+        "ghk": dict(simulator=mnp_utils.ghk_sim, simulator_grad=mnp_utils.ghk_sim_grad),
+    }
+    for name, options in runs.items():  # compile
+        mnp_utils.msm_estimator(*args, S=1, x0=1.0, method="BFGS", simulator_name=name, **options)
+    print(f"ghk vs stern (N={N}, m={m}, {reps} draw seeds, true b = 4):")
+    for s in S:
+        for name, options in runs.items():
+            t0 = time.perf_counter()
+            b = [
+                mnp_utils.msm_estimator(
+                    *args, S=s, x0=1.0, seed=seed, method="BFGS", simulator_name=name, **options
+                )[0]
+                for seed in range(reps)
+            ]
+            t = (time.perf_counter() - t0) / reps
+            print(
+                f"  S={s:3d} {name:14s}: b = {np.mean(b):.4f}, sd over draws {np.std(b):.4f}, "
+                f"{t:7.3f} s per estimate"
+            )
+
+
+BENCHMARKS = {
+    "stern": bench_stern,
+    "importance": bench_importance,
+    "criteria": bench_criteria,
+    "counter_draws": bench_counter_draws,
+    "ghk": bench_ghk,
+    "startup": bench_startup,
+}
+
+
+if __name__ == "__main__":
+    for name in sys.argv[1:] or BENCHMARKS:
+        BENCHMARKS[name]()
@@ -3,12 +3,11 @@ Functions for implementing the algorithms in McFadden(1989).
 """
 
 import numpy as np
-from numba import njit
-from scipy import optimize, stats
-from math import erf
+from numba import njit, prange
+from math import erf, erfc
 
 # 1. dgp
-@njit
+@njit(cache=True)
 def dgp(
     b, N, m, low=0.0, high=5.0, seed=1688,
 ):
@@ -45,7 +44,7 @@ def dgp(
 
 
 # 2. moments function
-@njit
+@njit(cache=True)
 def mom(y, z):
     """empirical moments for an observation. (just return observed y)
        
@@ -56,7 +55,7 @@ def mom(y, z):
 
 
 # 3. simulators
-@njit
+@njit(cache=True)
 def freq_sim(v, z, b):
     """simulate choice vector of an agent.
        return 1*m 0-1 vector of choice (m is number of alternatives).
@@ -73,10 +72,27 @@ def freq_sim(v, z, b):
     return y.reshape(-1, 1)  # return m*1 (0-1) vector of choice
 
 
-@njit
+@njit(cache=True)
+def freq_sim_into(v, z, b, out, workspace):
+    """freq_sim(v, z, b) written into the length-m vector out (no allocation).
+       workspace: unused (see imp_sim_chol_into).
+    """
+    j_max = 0
+    u_max = -np.inf
+    for j in range(z.shape[0]):
+        u_j = z[j, 0] + z[j, 1] * b + v[j]
+        if u_j > u_max:  # first maximum, as np.argmax
+            j_max, u_max = j, u_j
+        out[j] = 0.0
+    out[j_max] = 1.0
+
+
+@njit(cache=True)
 def imp_sim(r, z, b):
     """simulate choice vector of an agent based on importance function (exponential distribution).
        return 1*m 0-1 vector of simulated choice. (m is the number of alternatives.)
+       (legacy reference: φ is the density of all m*(m-1) draws, not of r[j] alone, so
+       the weights have infinite mean; imp_sim_chol uses the density of r[j].)
 
        r: m*(m-1) matrix of (positive) values drawn from exponential distribution. 
        z: m*2 matrix of attributes.
@@ -109,7 +125,77 @@ def imp_sim(r, z, b):
     return y.reshape(-1, 1)
 
 
-@njit
+@njit(cache=True)
+def imp_factors(Z):
+    """precompute the parts of the importance simulator which do not depend on b.
+       return N*m*k matrix, k = 1 + 2(m-1) + (m-1)^2. Row (i, j) holds for alternative
+       j of observation i:
+       1. -0.5 * log(det(2π cov)), where cov is the covariance matrix of the utility
+          differences.
+       2. z_j1 - z_l1 and z_j2 - z_l2 for the m-1 other alternatives l
+          (the mean of the differences is (z_j1 - z_l1) + (z_j2 - z_l2) * b).
+       3. L: (m-1)*(m-1) lower triangular Cholesky factor of cov (flattened by rows).
+
+       Z: N*m*2 matrix of attributes.
+    """
+    N, m = Z.shape[0], Z.shape[1]
+    k = 1 + 2 * (m - 1) + (m - 1) ** 2
+    F = np.zeros((N, m, k))
+    for i in range(N):
+        z = Z[i]
+        for j in range(m):  # loop for each alternative
+            z_j = z[j]
+            z_others = np.concatenate((z[:j, :], z[j + 1 :, :]), axis=0)
+            cov = np.sum(z_j ** 2) * np.ones((m - 1, m - 1)) + np.diag(
+                np.sum(z_others ** 2, axis=1)
+            )
+            L = np.linalg.cholesky(cov)
+            F[i, j, 0] = -0.5 * (m - 1) * np.log(2 * np.pi) - np.sum(np.log(np.diag(L)))
+            F[i, j, 1:m] = z_j[0] - z_others[:, 0]
+            F[i, j, m : 2 * m - 1] = z_j[1] - z_others[:, 1]
+            F[i, j, 2 * m - 1 :] = L.ravel()
+    return F
+
+
+@njit(cache=True)
+def imp_sim_chol(r, f, b):
+    """importance simulator on precomputed factors.
+       The normal pdf is evaluated in log space with a triangular solve, and divided by
+       the exponential density of r[j] alone, the proposal for alternative j (imp_sim
+       divides by the density of all m*(m-1) draws, so its weights have infinite mean).
+       return 1*m 0-1 vector of simulated choice. (m is the number of alternatives.)
+
+       r: m*(m-1) matrix of (positive) values drawn from exponential distribution.
+       f: m*k factors of an observation (see imp_factors).
+       b: preference parameter for attribute two.
+    """
+    y = np.zeros(f.shape[0])  # simulation results
+    imp_sim_chol_into(r, f, b, y, np.empty(f.shape[0]))
+    return y.reshape(-1, 1)
+
+
+@njit(cache=True)
+def imp_sim_chol_into(r, f, b, out, workspace):
+    """imp_sim_chol(r, f, b) written into the length-m vector out.
+       workspace: vector of length at least m-1 (no allocation).
+    """
+    m = f.shape[0]
+    x = workspace  # L^-1 (r_j - mean)
+    for j in range(m):  # loop for each alternative
+        log_φ = 0.0  # log pdf of the exponential proposal of alternative j at r_j
+        q = 0.0  # (r_j - mean)' cov^-1 (r_j - mean)
+        for l in range(m - 1):  # forward substitution
+            log_φ -= r[j, l]
+            row = 2 * m - 1 + l * (m - 1)
+            x_l = r[j, l] - (f[j, 1 + l] + f[j, m + l] * b)
+            for k in range(l):
+                x_l -= f[j, row + k] * x[k]
+            x[l] = x_l / f[j, row + l]
+            q += x[l] ** 2
+        out[j] = np.exp(f[j, 0] - 0.5 * q - log_φ)  # normal pdf at v / φ
+
+
+@njit(cache=True)
 def stern_sim(u, z, b):
     """simulate choice prob vector of an agent based on stern simulator (1992).
        return 1*m 0-1 vector of simulated choice. (m is the number of alternatives.)
@@ -153,8 +239,289 @@ def stern_sim(u, z, b):
     return y.reshape(-1, 1)
 
 
+@njit(cache=True)
+def stern_factors(Z):
+    """precompute the parts of the stern simulator which do not depend on b.
+       return N*m*k matrix, k = 1 + 2(m-1) + (m-1)^2. Row (i, j) holds for alternative
+       j of observation i:
+       1. a: square root of the minimal eigenvalue of the covariance matrix of the
+          utility differences (0 if the matrix is not positive definite).
+       2. z_j1 - z_l1 and z_j2 - z_l2 for the m-1 other alternatives l
+          (the utility differences are (z_j1 - z_l1) + (z_j2 - z_l2) * b).
+       3. C: (m-1)*(m-1) square root of cov - a^2 I (flattened by rows).
+
+       Z: N*m*2 matrix of attributes.
+    """
+    N, m = Z.shape[0], Z.shape[1]
+    k = 1 + 2 * (m - 1) + (m - 1) ** 2
+    F = np.zeros((N, m, k))
+    for i in range(N):
+        z = Z[i]
+        for j in range(m):  # loop for each alternative
+            z_j = z[j]
+            z_others = np.concatenate((z[:j, :], z[j + 1 :, :]), axis=0)
+            cov = np.sum(z_j ** 2) * np.ones((m - 1, m - 1)) + np.diag(
+                np.sum(z_others ** 2, axis=1)
+            )
+            F[i, j, 1:m] = z_j[0] - z_others[:, 0]
+            F[i, j, m : 2 * m - 1] = z_j[1] - z_others[:, 1]
+            λ = np.min(np.linalg.eig(cov)[0])  # minimal eigenvalue of cov matrix
+            if λ > 0:
+                F[i, j, 0] = λ ** 0.5
+                e_values, e_vectors = np.linalg.eig(cov - λ * np.eye(m - 1))
+                e_values[e_values < 0] = 0
+                C = (
+                    e_vectors @ np.diag(np.sqrt(e_values)) @ e_vectors.T
+                )  # square root of matrix
+                F[i, j, 2 * m - 1 :] = C.ravel()
+    return F
+
+
+@njit(cache=True)
+def stern_sim_factored(u, f, b):
+    """stern simulator (1992) on precomputed factors, the same as stern_sim(u, z, b).
+       return 1*m 0-1 vector of simulated choice. (m is the number of alternatives.)
+
+       u: m*(m-1) matrix drawn from standard normal distribution.
+       f: m*k factors of an observation (see stern_factors).
+       b: preference parameter for attribute two.
+    """
+    y = np.zeros(f.shape[0])  # simulation results
+    stern_sim_factored_into(u, f, b, y, np.empty(0))
+    return y.reshape(-1, 1)
+
+
+@njit(cache=True)
+def stern_sim_factored_into(u, f, b, out, workspace):
+    """stern_sim_factored(u, f, b) written into the length-m vector out (no allocation).
+       workspace: unused (see imp_sim_chol_into).
+    """
+    m = f.shape[0]
+    for j in range(m):  # loop for each alternative
+        a = f[j, 0]
+        prob = 0.0
+        if a > 0:
+            prob = 1.0  # initialize prob of choosing j
+            for l in range(m - 1):  # loop for the other alternatives
+                diff = f[j, 1 + l] + f[j, m + l] * b
+                Cu = 0.0
+                for k in range(m - 1):
+                    Cu += f[j, 2 * m - 1 + l * (m - 1) + k] * u[j, k]
+                prob *= 1 - 0.5 * (1 + erf((-diff - Cu) / (a * 2 ** 0.5)))
+        out[j] = prob
+
+
+@njit(cache=True)
+def norm_cdf(x):
+    """standard normal cdf (accurate in the lower tail)."""
+    return 0.5 * erfc(-x / 2 ** 0.5)
+
+
+@njit(cache=True)
+def norm_pdf(x):
+    """standard normal pdf."""
+    return np.exp(-0.5 * x * x) / (2 * np.pi) ** 0.5
+
+
+@njit(cache=True)
+def norm_ppf(p):
+    """inverse of the standard normal cdf, for 0 < p < 1.
+       Acklam's rational approximation (relative error 1.15e-9) refined by one Halley step.
+    """
+    a = (-3.969683028665376e01, 2.209460984245205e02, -2.759285104469687e02,
+         1.383577518672690e02, -3.066479806614716e01, 2.506628277459239e00)
+    b = (-5.447609879822406e01, 1.615858368580409e02, -1.556989798598866e02,
+         6.680131188771972e01, -1.328068155288572e01)
+    c = (-7.784894002430293e-03, -3.223964580411365e-01, -2.400758277161838e00,
+         -2.549732539343734e00, 4.374664141464968e00, 2.938163982698783e00)
+    d = (7.784695709041462e-03, 3.224671290700398e-01, 2.445134137142996e00,
+         3.754408661907416e00)
+    if p < 0.02425:  # lower tail
+        q = (-2 * np.log(p)) ** 0.5
+        x = (((((c[0] * q + c[1]) * q + c[2]) * q + c[3]) * q + c[4]) * q + c[5]) / (
+            (((d[0] * q + d[1]) * q + d[2]) * q + d[3]) * q + 1
+        )
+    elif p <= 1 - 0.02425:  # central region
+        q = p - 0.5
+        r = q * q
+        x = (((((a[0] * r + a[1]) * r + a[2]) * r + a[3]) * r + a[4]) * r + a[5]) * q / (
+            ((((b[0] * r + b[1]) * r + b[2]) * r + b[3]) * r + b[4]) * r + 1
+        )
+    else:  # upper tail
+        q = (-2 * np.log(1 - p)) ** 0.5
+        x = -(((((c[0] * q + c[1]) * q + c[2]) * q + c[3]) * q + c[4]) * q + c[5]) / (
+            (((d[0] * q + d[1]) * q + d[2]) * q + d[3]) * q + 1
+        )
+    # Halley step on norm_cdf(x) - p (from the upper tail's complement above the median)
+    e = norm_cdf(x) - p if p <= 0.5 else (1 - p) - norm_cdf(-x)
+    pdf = norm_pdf(x)
+    if pdf > 0:
+        u = e / pdf
+        x = x - u / (1 + 0.5 * x * u)
+    return x
+
+
+@njit(cache=True)
+def ghk_sim(u, f, b):
+    """simulate choice prob vector of an agent with the GHK simulator
+       (Geweke, Hajivassiliou and Keane). The probability of choosing j, P(η < diff) with η
+       the m-1 differences of unobserved utilities (η = L e, L the Cholesky factor of their
+       covariance), is the product of the probabilities of the bounds on e_1, e_2, ...,
+       drawing each e_l from the standard normal truncated by its bound.
+       return 1*m vector of simulated choice probabilities. (m is the number of alternatives.)
+
+       u: m*(m-1) matrix drawn from standard normal distribution (as for stern_sim;
+          norm_cdf(u) are the uniforms of the truncated draws).
+       f: m*k factors of an observation (see imp_factors; GHK uses the Cholesky factors).
+       b: preference parameter for attribute two.
+    """
+    y = np.zeros(f.shape[0])  # simulation results
+    ghk_sim_into(u, f, b, y, np.empty(f.shape[0]))
+    return y.reshape(-1, 1)
+
+
+@njit(cache=True)
+def ghk_sim_into(u, f, b, out, workspace):
+    """ghk_sim(u, f, b) written into the length-m vector out.
+       workspace: vector of length at least m-1 (no allocation).
+    """
+    m = f.shape[0]
+    e = workspace  # truncated standard normal draws
+    for j in range(m):  # loop for each alternative
+        prob = 1.0
+        for l in range(m - 1):  # loop for the other alternatives
+            row = 2 * m - 1 + l * (m - 1)
+            t = f[j, 1 + l] + f[j, m + l] * b  # bound of e_l: (diff_l - L_l,<l e_<l) / L_ll
+            for k in range(l):
+                t -= f[j, row + k] * e[k]
+            t /= f[j, row + l]
+            Φ_t = norm_cdf(t)
+            prob *= Φ_t
+            if prob == 0:
+                break
+            e[l] = norm_ppf(norm_cdf(u[j, l]) * Φ_t)
+        out[j] = prob
+
+
+@njit(cache=True)
+def ghk_sim_grad(u, f, b):
+    """ghk_sim(u, f, b) and its derivative w.r.t. b (for the same draws u).
+       return m*1 simulated choice probabilities and m*1 derivatives.
+    """
+    m = f.shape[0]
+    y = np.zeros(m)
+    dy = np.zeros(m)
+    e = np.empty(m - 1)  # truncated standard normal draws
+    de = np.empty(m - 1)  # their derivatives w.r.t. b
+    for j in range(m):  # loop for each alternative
+        prob = 1.0
+        dlog_prob = 0.0
+        for l in range(m - 1):  # loop for the other alternatives
+            row = 2 * m - 1 + l * (m - 1)
+            t = f[j, 1 + l] + f[j, m + l] * b
+            dt = f[j, m + l]
+            for k in range(l):
+                t -= f[j, row + k] * e[k]
+                dt -= f[j, row + k] * de[k]
+            t /= f[j, row + l]
+            dt /= f[j, row + l]
+            Φ_t = norm_cdf(t)
+            prob *= Φ_t
+            if prob == 0:
+                break
+            dlog_prob += norm_pdf(t) / Φ_t * dt
+            v = norm_cdf(u[j, l])
+            e[l] = norm_ppf(v * Φ_t)
+            # e_l = Φ^-1(v Φ(t)), so de_l = v φ(t) dt / φ(e_l)
+            φ_e = norm_pdf(e[l])
+            de[l] = v * norm_pdf(t) * dt / φ_e if φ_e > 0 else 0.0
+        y[j] = prob
+        dy[j] = prob * dlog_prob if prob > 0 else 0.0
+    return y.reshape(-1, 1), dy.reshape(-1, 1)
+
+
+# random terms drawn on the fly: Philox4x32-10 (Salmon et al. 2011), a counter-based
+# generator. The draws of observation i and simulation s are a function of
+# (seed, i, s) only, so they are the same in every criteria evaluation (common random
+# numbers), in any order and on any thread, and need not be stored.
+_M0, _M1 = np.uint64(0xD2511F53), np.uint64(0xCD9E8D57)
+_W0, _W1 = np.uint64(0x9E3779B9), np.uint64(0xBB67AE85)
+_MASK32 = np.uint64(0xFFFFFFFF)
+
+
+@njit(cache=True)
+def philox4x32(c0, c1, c2, c3, k0, k1):
+    """Philox4x32-10 block of the 32-bit counter (c0, c1, c2, c3) and key (k0, k1).
+       return 4 pseudo-random 32-bit words (as uint64).
+    """
+    c0, c1, c2, c3 = np.uint64(c0), np.uint64(c1), np.uint64(c2), np.uint64(c3)
+    k0, k1 = np.uint64(k0), np.uint64(k1)
+    for _ in range(10):
+        p0, p1 = _M0 * c0, _M1 * c2
+        c0, c1, c2, c3 = (
+            (p1 >> np.uint64(32)) ^ c1 ^ k0,
+            p1 & _MASK32,
+            (p0 >> np.uint64(32)) ^ c3 ^ k1,
+            p0 & _MASK32,
+        )
+        k0, k1 = (k0 + _W0) & _MASK32, (k1 + _W1) & _MASK32
+    return c0, c1, c2, c3
+
+
+@njit(cache=True)
+def counter_uniforms(seed, i, s, n):
+    """u_n, u_n+1 in (0, 1): uniforms number n and n+1 (n even) of observation i, simulation s."""
+    seed, i = np.uint64(seed), np.uint64(i)
+    x0, x1, x2, x3 = philox4x32(
+        n // 2, s, i & _MASK32, i >> np.uint64(32), seed & _MASK32, seed >> np.uint64(32)
+    )
+    # 53 random bits per uniform, shifted off 0
+    u0 = ((x0 >> np.uint64(5)) * 67108864.0 + (x1 >> np.uint64(6)) + 0.5) / 9007199254740992.0
+    u1 = ((x2 >> np.uint64(5)) * 67108864.0 + (x3 >> np.uint64(6)) + 0.5) / 9007199254740992.0
+    return u0, u1
+
+
+@njit(cache=True)
+def normal_draws_into(seed, i, s, z, out):
+    """standard normal random terms of observation i and simulation s (Box-Muller),
+       written into out (e.g. the m*(m-1) u of stern_sim). z is not used.
+    """
+    v = out.reshape(-1)
+    for n in range(0, v.shape[0], 2):
+        u0, u1 = counter_uniforms(seed, i, s, n)
+        r = (-2.0 * np.log(u0)) ** 0.5
+        v[n] = r * np.cos(2 * np.pi * u1)
+        if n + 1 < v.shape[0]:
+            v[n + 1] = r * np.sin(2 * np.pi * u1)
+
+
+@njit(cache=True)
+def exponential_draws_into(seed, i, s, z, out):
+    """standard exponential random terms of observation i and simulation s,
+       written into out (e.g. the m*(m-1) r of imp_sim). z is not used.
+    """
+    v = out.reshape(-1)
+    for n in range(0, v.shape[0], 2):
+        u0, u1 = counter_uniforms(seed, i, s, n)
+        v[n] = -np.log(u0)
+        if n + 1 < v.shape[0]:
+            v[n + 1] = -np.log(u1)
+
+
+@njit(cache=True)
+def freq_draws_into(seed, i, s, z, out):
+    """heterogenous preferences v of freq_sim for observation i and simulation s:
+       normal with standard deviation |z_j| (as in msm_estimator), written into out.
+
+       z: m*2 matrix of attributes.
+    """
+    normal_draws_into(seed, i, s, z, out)
+    for j in range(out.shape[0]):
+        out[j] *= (z[j, 0] ** 2 + z[j, 1] ** 2) ** 0.5
+
+
 # 4. IV function
-@njit
+@njit(cache=True)
 def simple_iv(z):
     """
     Generate a naive IV matrix (constant and z) for an observation.
@@ -165,9 +532,10 @@ def simple_iv(z):
 
 
 # 4. estimator
+# (not cached: numba cannot cache functions taking jitted functions as arguments)
 @njit
 def msm_criteria(
-    b, Z, Y, iv, mom_func, simulator, V, S, W=None,
+    b, Z, Y, iv, mom_func, simulator, V, S, W=None, Z_sim=None,
 ):
     """MSM criteria function.
     
@@ -180,7 +548,11 @@ def msm_criteria(
        V: N*S*... matrix of v drawn from its distribution.(dim of V depends on the simulator)
        S: number of simulations.  
        W: weighting matrix. (identity matrix by default)
+       Z_sim: data passed to the simulator for each observation (Z by default),
+       e.g. stern_factors(Z) for stern_sim_factored.
     """
+    if Z_sim is None:
+        Z_sim = Z
     n = Z.shape[0]  # number of observations
     p = iv(Z[0]).shape[0]  # number of technical moment conditions (rows of IV matrix)
     q = mom_func(Y[0], Z[0]).shape[0]  # number of raw moments (rows of mom(yi, zi))
@@ -193,12 +565,184 @@ def msm_criteria(
         sim_mom = np.zeros((q, 1))
         # simulated empirical moments
         for s in range(S):
-            sim_mom += (1 / S) * simulator(V[i, s,], Z[i], b)
+            sim_mom += (1 / S) * simulator(V[i, s,], Z_sim[i], b)
         g += iv(Z[i]) @ (mom_func(Y[i], Z[i]) - sim_mom)
 
     return (g.T @ W @ g)[0, 0]  # change scalar array to number
 
 
+# (not cached, see msm_criteria)
+@njit
+def msm_criteria_grad(
+    b, Z, Y, iv, mom_func, simulator_grad, V, S, W=None, Z_sim=None,
+):
+    """MSM criteria function and its derivative w.r.t. b.
+
+       simulator_grad: simulator returning the simulated moments and their derivatives
+       w.r.t. b, e.g. ghk_sim_grad.
+       (other arguments as in msm_criteria)
+    """
+    if Z_sim is None:
+        Z_sim = Z
+    n = Z.shape[0]  # number of observations
+    p = iv(Z[0]).shape[0]  # number of technical moment conditions (rows of IV matrix)
+    q = mom_func(Y[0], Z[0]).shape[0]  # number of raw moments (rows of mom(yi, zi))
+
+    if W == None:
+        W = np.eye(p)
+
+    g = np.zeros((p, 1))  # sum of moment conditions for all observations
+    dg = np.zeros((p, 1))  # its derivative w.r.t. b
+    for i in range(n):
+        sim_mom = np.zeros((q, 1))
+        d_sim_mom = np.zeros((q, 1))
+        # simulated empirical moments
+        for s in range(S):
+            y, dy = simulator_grad(V[i, s,], Z_sim[i], b)
+            sim_mom += (1 / S) * y
+            d_sim_mom += (1 / S) * dy
+        g += iv(Z[i]) @ (mom_func(Y[i], Z[i]) - sim_mom)
+        dg -= iv(Z[i]) @ d_sim_mom
+
+    return (g.T @ W @ g)[0, 0], (dg.T @ (W + W.T) @ g)[0, 0]
+
+
+# (not cached, see msm_criteria)
+@njit
+def data_moments(Z, Y, iv, mom_func):
+    """parts of the moment conditions which do not depend on b.
+       return:
+       1. p*1 sum of iv(Z[i]) @ mom_func(Y[i], Z[i]) over observations.
+       2. N*p*q stack of the IV matrices iv(Z[i]).
+    """
+    n = Z.shape[0]  # number of observations
+    iv0 = iv(Z[0])
+    IV = np.empty((n,) + iv0.shape)
+    g = np.zeros((iv0.shape[0], 1))
+    for i in range(n):
+        IV[i] = iv(Z[i])
+        g += IV[i] @ mom_func(Y[i], Z[i])
+    return g, IV
+
+
+# (not cached, see msm_criteria)
+@njit(parallel=True)
+def simulated_moments(b, IV, Z_sim, V, simulator_into, n_chunks):
+    """p*1 sum over observations of iv(Z[i]) @ (mean of the S simulated moments).
+
+       Observations are split into n_chunks fixed chunks with their own
+       accumulators and buffers, so the sum does not depend on the number of threads.
+
+       IV: N*p*q stack of IV matrices (see data_moments).
+       Z_sim: data passed to the simulator for each observation.
+       V: N*S*... matrix of random terms.
+       simulator_into: in-place simulator (v, z, b, out, workspace), e.g. stern_sim_factored_into.
+    """
+    n, p, q = IV.shape
+    S = V.shape[1]
+    G = np.zeros((n_chunks, p))
+    for c in prange(n_chunks):
+        y = np.empty(q)  # moments of one draw
+        sim_mom = np.empty(q)  # sum of the moments of the S draws
+        workspace = np.empty(Z_sim.shape[1])
+        for i in range(c * n // n_chunks, (c + 1) * n // n_chunks):
+            sim_mom[:] = 0.0
+            for s in range(S):
+                simulator_into(V[i, s], Z_sim[i], b, y, workspace)
+                for k in range(q):
+                    sim_mom[k] += y[k]
+            for r in range(p):
+                for k in range(q):
+                    G[c, r] += IV[i, r, k] * sim_mom[k] / S
+    return G.sum(axis=0).reshape(-1, 1)
+
+
+# (not cached, see msm_criteria)
+@njit(parallel=True)
+def simulated_moments_counter(b, IV, Z_sim, S, draw_into, seed, v, simulator_into):
+    """simulated_moments with random terms drawn on the fly by draw_into (seed, i, s, z, out),
+       e.g. normal_draws_into, instead of read from a stored N*S*... matrix V.
+
+       v: n_chunks*... buffers for the random terms of one draw, one per chunk.
+    """
+    n, p, q = IV.shape
+    n_chunks = v.shape[0]
+    G = np.zeros((n_chunks, p))
+    for c in prange(n_chunks):
+        y = np.empty(q)  # moments of one draw
+        sim_mom = np.empty(q)  # sum of the moments of the S draws
+        workspace = np.empty(Z_sim.shape[1])
+        for i in range(c * n // n_chunks, (c + 1) * n // n_chunks):
+            sim_mom[:] = 0.0
+            for s in range(S):
+                draw_into(seed, i, s, Z_sim[i], v[c])
+                simulator_into(v[c], Z_sim[i], b, y, workspace)
+                for k in range(q):
+                    sim_mom[k] += y[k]
+            for r in range(p):
+                for k in range(q):
+                    G[c, r] += IV[i, r, k] * sim_mom[k] / S
+    return G.sum(axis=0).reshape(-1, 1)
+
+
+def make_msm_criteria(
+    Z,
+    Y,
+    iv,
+    mom_func,
+    simulator_into,
+    V,
+    S=None,
+    W=None,
+    Z_sim=None,
+    n_chunks=64,
+    draw_into=None,
+    seed=0,
+    draw_shape=None,
+):
+    """MSM criteria function of b, evaluated in parallel (the same as msm_criteria).
+
+       The data moments and the IV matrices are computed once (see data_moments);
+       each evaluation only simulates, with a parallel reduction over observations
+       (see simulated_moments).
+
+       Z, Y, iv, mom_func, V, W, Z_sim: as in msm_criteria.
+       simulator_into: in-place version of the simulator, e.g. stern_sim_factored_into
+       for stern_sim_factored, imp_sim_chol_into or freq_sim_into.
+       S: number of simulations (all of V's by default).
+       n_chunks: number of fixed chunks of observations with their own accumulators.
+       draw_into: if V is None, function (seed, i, s, z, out) drawing the random terms of
+       observation i and simulation s on the fly (normal_draws_into, exponential_draws_into
+       or freq_draws_into), so memory does not grow with N*S.
+       seed: seed of draw_into.
+       draw_shape: shape of the random terms of one draw ((m, m-1) for stern, (m,) for frequency).
+    """
+    g_data, IV = data_moments(Z, Y, iv, mom_func)
+    if W is None:
+        W = np.eye(IV.shape[1])
+    if Z_sim is None:
+        Z_sim = Z
+    if V is None:
+        v = np.empty((n_chunks,) + tuple(draw_shape))
+
+        def simulate(b):
+            return simulated_moments_counter(
+                b, IV, Z_sim, S, draw_into, seed, v, simulator_into
+            )
+
+    else:
+        V = V[:, :S]
+
+        def simulate(b):
+            return simulated_moments(b, IV, Z_sim, V, simulator_into, n_chunks)
+
+    def criteria(b):
+        g = g_data - simulate(float(b))
+        return (g.T @ W @ g)[0, 0]
+
+    return criteria
+
+
 def msm_estimator(
     Z,
     Y,
@@ -209,8 +753,11 @@ def msm_estimator(
     W=None,
     x0=0,
     seed=476,
-    method="Nelder-Mead",
+    method=None,
     simulator_name="frequency",
+    simulator_into=None,
+    draws="stored",
+    simulator_grad=None,
 ):
     """MSM estimator.
 
@@ -223,14 +770,55 @@ def msm_estimator(
        S: number of simulations.  
        seed: used for simulation.   
        method: method used in scipy minimizer. (frequency simulator can only use Nelder-Mead)
-       simulator_name: "frequency", "stern" (this determine how to draw random terms.)
+       (Nelder-Mead by default, BFGS with simulator_grad, which needs a gradient-based method.)
+       simulator_name: "frequency", "importance", "importance_chol", "stern", "stern_factored"
+       or "ghk" (this determine how to draw random terms; "importance_chol" is for imp_sim_chol,
+       "stern_factored" for stern_sim_factored and "ghk" for ghk_sim, whose factors are
+       computed once.)
+       simulator_into: in-place version of simulator (e.g. stern_sim_factored_into);
+       if given, the criteria is evaluated in parallel by make_msm_criteria. It must match
+       the data of simulator_name: stern_sim_factored_into with "stern_factored",
+       imp_sim_chol_into with "importance_chol", ghk_sim_into with "ghk" and
+       freq_sim_into with "frequency".
+       draws: "stored" (draw all N*S random terms up front) or "counter" (draw them on the fly
+       from (seed, i, s) in the criteria kernel, which needs simulator_into).
+       simulator_grad: simulator also returning the derivatives of the moments w.r.t. b
+       (e.g. ghk_sim_grad with simulator_name="ghk"); if given, the minimizer uses the
+       analytic gradient of the criteria. Needs stored draws.
     """
+    from scipy import optimize  # (slow to import, so only when estimating)
+
     np.random.seed(seed)
     N = Z.shape[0]  # number of observations
     m = Z.shape[1]  # number of alternatives
 
-    # create random terms for simulation
-    if simulator_name == "frequency":
+    if simulator_name not in (
+        "frequency", "importance", "importance_chol", "stern", "stern_factored", "ghk"
+    ):
+        raise TypeError("Unknown Simulator!")
+    if draws not in ("stored", "counter"):
+        raise ValueError(f"Unknown draws: {draws}")
+    if draws == "counter" and simulator_into is None:
+        raise ValueError("Counter-based draws need simulator_into.")
+    if simulator_into is not None and simulator_name in ("importance", "stern"):
+        # the in-place simulators read precomputed factors (or, for frequency, the raw Z)
+        raise ValueError(
+            'simulator_into needs simulator_name "importance_chol", "stern_factored", '
+            f'"ghk" or "frequency", not "{simulator_name}".'
+        )
+    if draws == "counter" and simulator_grad is not None:
+        raise ValueError("The analytic gradient needs stored draws.")
+    if method is None:
+        method = "Nelder-Mead" if simulator_grad is None else "BFGS"
+    elif simulator_grad is not None and method.lower() in (
+        "nelder-mead", "powell", "cobyla", "cobyqa"
+    ):
+        raise ValueError(f"Method {method} does not use the gradient of simulator_grad.")
+
+    # create random terms for simulation (counter-based draws are made in the criteria)
+    if draws == "counter":
+        V = None
+    elif simulator_name == "frequency":
         V = np.empty((N, S, m))
         u = np.random.normal(
             0, 1, (N, S, m)
@@ -238,20 +826,53 @@ def msm_estimator(
         std = np.sum(Z ** 2, axis=2) ** 0.5
         for s in range(S):
             V[:, s, :] = std * u[:, s, :]
-    elif simulator_name == "stern":
+    elif simulator_name in ("importance", "importance_chol"):
+        V = np.random.exponential(1, (N, S, m, m - 1))
+    else:
         V = np.random.normal(0, 1, (N, S, m, m - 1))
+    if simulator_name in ("importance_chol", "ghk"):
+        Z_sim = imp_factors(Z)
+    elif simulator_name == "stern_factored":
+        Z_sim = stern_factors(Z)
     else:
-        raise TypeError("Unknown Simulator!")
+        Z_sim = Z
 
     # criteria function
-    def f(b):
-        # float(b)!! or python will treat b as array.
-        # scale the criteria
-        return msm_criteria(float(b), Z, Y, iv, mom_func, simulator, V, S, W,) / 1e6
+    if simulator_into is None:
+        criteria = lambda b: msm_criteria(b, Z, Y, iv, mom_func, simulator, V, S, W, Z_sim)
+    else:
+        if simulator_name == "frequency":
+            draw_into, draw_shape = freq_draws_into, (m,)
+        elif simulator_name in ("importance", "importance_chol"):
+            draw_into, draw_shape = exponential_draws_into, (m, m - 1)
+        else:
+            draw_into, draw_shape = normal_draws_into, (m, m - 1)
+        criteria = make_msm_criteria(
+            Z, Y, iv, mom_func, simulator_into, V, S, W, Z_sim,
+            draw_into=draw_into, seed=seed, draw_shape=draw_shape,
+        )
+
+    if simulator_grad is None:
+        jac = None
+
+        def f(b):
+            # b[0]!! or python will treat b as array.
+            # scale the criteria
+            return criteria(b[0]) / 1e6
+
+    else:
+        jac = True
+
+        def f(b):
+            # criteria and its gradient, scaled
+            value, grad = msm_criteria_grad(
+                b[0], Z, Y, iv, mom_func, simulator_grad, V, S, W, Z_sim
+            )
+            return value / 1e6, np.array([grad / 1e6])
 
     # BFGS doesn't work for frequency simulator
     # since criteria is not continuous under frequency simulator.
-    res = optimize.minimize(f, x0=x0, method=method, tol=None)
+    res = optimize.minimize(f, x0=x0, method=method, jac=jac, tol=None)
 
     if res.success == False:
         print(res)
@@ -261,14 +882,16 @@ def msm_estimator(
     return res.x
 
 
+# (not cached, see msm_criteria)
 @njit
 def approx_moments(b, z, simulator, U):
     """use large number of simulations to approximate 
        the conditional theoretical moments for an observation.
 
        z: m*2 data matrix of exogenous variables. (first dim is obs)
+       (or the data of the simulator, e.g. stern_factors(Z)[i] for stern_sim_factored)
        simulator: simulator of moments w.r.t. (u, z, b), where u is the drawn from normal distribution.
-       (Notice that only stern simulator is allowed now!)
+       (Notice that only stern and ghk simulators are allowed now!)
 
        U: S2 * m * m-1 matrix of random terms.
        (S2 is the number of simulations used to approximate the theoretical moments.)
@@ -285,6 +908,7 @@ def approx_moments(b, z, simulator, U):
     return y
 
 
+# (not cached, see msm_criteria)
 @njit
 def cov_estimator(
     b,
@@ -299,6 +923,7 @@ def cov_estimator(
     S=1,
     S2=100,
     optimal_weighting=False,
+    Z_sim=None,
 ):
     """estimate 1.the asymptotic covariance matrix for smooth simulator, 
                 2. optimal weighting matrix.
@@ -312,11 +937,20 @@ def cov_estimator(
        S: number of simulations.  
        W: weighting matrix. (identity matrix by default)
        seed: used for simulation.   
-       simulator_name: "stern" (this determine how to simulate theoretical moments.)
+       simulator_name: "stern", "stern_factored" or "ghk" (this determine how to simulate
+       theoretical moments.)
        S2: how many draws are used to simulate the theoretical moments. (S2 should be large enough)
        optimal_weighting: whether to use the simplified covariance matrix for optimal weighting matrix.
+       Z_sim: data passed to the simulator for each observation (Z by default),
+       e.g. stern_factors(Z) for stern_sim_factored or imp_factors(Z) for ghk_sim.
     """
-    assert simulator_name == "stern", "The simulator is not allowed!!"
+    assert (
+        simulator_name == "stern"
+        or simulator_name == "stern_factored"
+        or simulator_name == "ghk"
+    ), "The simulator is not allowed!!"
+    if Z_sim is None:
+        Z_sim = Z
     N = Z.shape[0]  # number of observations
     m = Z.shape[1]  # number of alternatives
     p = iv(Z[0]).shape[0]  # number of technical moment conditions (rows of IV matrix)
@@ -334,8 +968,8 @@ def cov_estimator(
             * iv(Z[i])
             @ (
                 (
-                    approx_moments(b + 0.5 * h, Z[i], simulator, U)
-                    - approx_moments(b - 0.5 * h, Z[i], simulator, U)
+                    approx_moments(b + 0.5 * h, Z_sim[i], simulator, U)
+                    - approx_moments(b - 0.5 * h, Z_sim[i], simulator, U)
                 )
                 / h
             )
@@ -352,7 +986,7 @@ def cov_estimator(
         U1 = np.random.normal(0, 1, (N, m, m - 1))  # random terms in simulators
         for i in range(N):
             thm_mom = approx_moments(
-                b, Z[i], simulator, U
+                b, Z_sim[i], simulator, U
             )  # approximated theoretical moments conditional on Zi
             gmm_var = (
                 iv(Z[i])
@@ -363,8 +997,8 @@ def cov_estimator(
             sim_noise = (
                 (1 / S)
                 * iv(Z[i])
-                @ (simulator(U1[i], Z[i], b) - thm_mom)
-                @ (simulator(U1[i], Z[i], b) - thm_mom).T
+                @ (simulator(U1[i], Z_sim[i], b) - thm_mom)
+                @ (simulator(U1[i], Z_sim[i], b) - thm_mom).T
                 @ iv(Z[i]).T
             )
             meat += (1 / N) * (gmm_var + sim_noise)
@@ -0,0 +1,183 @@
+"""
+Accelerated solvers for the fixed point x = G(x) of the EGM operators.
+
+All solvers stop when max|G(x) - x| < tol, the criterion of the plain EGM loops,
+and return the solution together with a dict reporting the method that
+produced it, the number of evaluations of G and the wall time.
+"""
+import time
+
+import numpy as np
+
+
+def fixed_point(G, x0, tol=1e-9, max_iter=10_000):
+    """Plain successive approximation x <- G(x).
+
+    Returns
+    -------
+    x: G(x) at the last iteration.
+    info: dict with "method", "iterations", "time" and "converged".
+    """
+    t0 = time.perf_counter()
+    x = x0
+    for i in range(max_iter):
+        g = G(x)
+        if np.max(np.abs(g - x)) < tol:
+            return g, _info("fixed_point", i + 1, t0, True)
+        x = g
+    return x, _info("fixed_point", max_iter, t0, False)
+
+
+def anderson(G, x0, tol=1e-9, max_iter=10_000, memory=5, safeguard=1.0, fallback=None):
+    """Anderson-accelerated fixed-point iteration (type II, undamped).
+
+    The next iterate extrapolates from the last `memory` evaluations of G. An
+    extrapolated step is rejected, and the history cleared, when G fails or is
+    not finite there, or the residual grows by more than a factor `safeguard`; a plain
+    step x <- G(x) is then taken instead. If Anderson has not converged after
+    max_iter evaluations, `fallback` (a solver with the signature of
+    `fixed_point`) continues from the last iterate.
+
+    Parameters
+    ----------
+    G: operator mapping arrays to arrays of the same shape.
+    x0: initial guess.
+    tol: tolerance on max|G(x) - x|.
+    max_iter: maximum number of evaluations of G.
+    memory: number of past differences used in the extrapolation.
+    safeguard: largest accepted ratio of successive residuals (1: never let it grow).
+    fallback: solver used when Anderson does not converge (plain iteration by default).
+
+    Returns
+    -------
+    x: G(x) at the solution.
+    info: dict with "method", "iterations", "time", "converged" and "restarts".
+    """
+    t0 = time.perf_counter()
+    shape = np.shape(x0)
+    x = np.ravel(x0).astype(np.float64)
+    g = np.ravel(G(x.reshape(shape)))
+    f = g - x
+    res = np.max(np.abs(f))
+    n_eval, restarts = 1, 0
+    dG, dF = [], []  # histories of differences of G(x) and of the residuals
+
+    while res >= tol and n_eval < max_iter:
+        if dF:
+            γ = np.linalg.lstsq(np.column_stack(dF), f, rcond=None)[0]
+            x1 = g - np.column_stack(dG) @ γ
+        else:
+            x1 = g
+        try:
+            g1 = np.ravel(G(x1.reshape(shape)))
+            f1 = g1 - x1
+            res1 = np.max(np.abs(f1))
+        except (ValueError, ArithmeticError, np.linalg.LinAlgError):
+            if not dF:  # G failed at a plain step: nothing to fall back on
+                raise
+            res1 = np.nan
+        n_eval += 1
+
+        if dF and not (np.isfinite(res1) and res1 <= safeguard * res):
+            # reject the extrapolation: restart from a plain step
+            dG, dF = [], []
+            restarts += 1
+            x1 = g
+            g1 = np.ravel(G(x1.reshape(shape)))
+            n_eval += 1
+            f1 = g1 - x1
+            res1 = np.max(np.abs(f1))
+        else:
+            dG.append(g1 - g)
+            dF.append(f1 - f)
+            if len(dF) > memory:
+                dG.pop(0)
+                dF.pop(0)
+
+        x, g, f, res = x1, g1, f1, res1
+
+    if res >= tol:
+        fallback = fixed_point if fallback is None else fallback
+        g, info = fallback(G, g.reshape(shape), tol=tol)
+        info.update(
+            method="anderson+" + info["method"],
+            iterations=n_eval + info["iterations"],
+            time=time.perf_counter() - t0,
+            restarts=restarts,
+        )
+        return g, info
+
+    info = _info("anderson", n_eval, t0, True)
+    info["restarts"] = restarts
+    return g.reshape(shape), info
+
+
+def newton_krylov(
+    G, x0, tol=1e-9, max_iter=200, fallback=None, inner_method="gmres", inner_maxiter=10,
+    line_search=None, **kwargs
+):
+    """Newton-Krylov solve of the residual G(x) - x = 0 (scipy.optimize.newton_krylov).
+
+    Each Newton step uses finite-difference Jacobian-vector products of G. If the
+    Newton solve fails or does not reach tol, `fallback` (plain iteration by
+    default) continues from the iterate with the smallest residual.
+
+    The defaults (a few restarted GMRES iterations per Newton step, full steps)
+    suit EGM operators, whose residual is nearly linear but poorly conditioned:
+    with scipy's defaults (LGMRES with an Armijo line search) most evaluations
+    go to the line search. Each evaluation of G goes through Python, so prefer
+    a compiled plain loop unless G is expensive and plain iteration needs many
+    steps (see `bench_accel` in bench_egm.py).
+
+    Parameters
+    ----------
+    inner_method, inner_maxiter: Krylov solver of the Newton steps and its iteration limit.
+    line_search: line search of the Newton steps (None for full steps, or "armijo").
+    kwargs: other options of scipy.optimize.newton_krylov.
+
+    Returns
+    -------
+    x: the solution.
+    info: dict with "method", "iterations" (evaluations of G), "time" and "converged".
+    """
+    from scipy.optimize import NoConvergence
+    from scipy.optimize import newton_krylov as scipy_newton_krylov
+
+    t0 = time.perf_counter()
+    shape = np.shape(x0)
+    state = {"n_eval": 0, "x": np.asarray(x0, dtype=np.float64), "res": np.inf}
+
+    def F(x):
+        state["n_eval"] += 1
+        f = G(x.reshape(shape)) - x.reshape(shape)
+        res = np.max(np.abs(f))
+        if res < state["res"]:  # False for nan
+            state["x"], state["res"] = x.reshape(shape).copy(), res
+        return f.reshape(x.shape)
+
+    try:
+        x = scipy_newton_krylov(
+            F, state["x"], f_tol=tol, maxiter=max_iter, method=inner_method,
+            inner_maxiter=inner_maxiter, line_search=line_search, **kwargs
+        )
+        return x, _info("newton_krylov", state["n_eval"], t0, True)
+    except (NoConvergence, ValueError, ArithmeticError, np.linalg.LinAlgError):
+        pass
+
+    fallback = fixed_point if fallback is None else fallback
+    x, info = fallback(G, state["x"], tol=tol)
+    info.update(
+        method="newton_krylov+" + info["method"],
+        iterations=state["n_eval"] + info["iterations"],
+        time=time.perf_counter() - t0,
+    )
+    return x, info
+
+
+def _info(method, iterations, t0, converged):
+    return {
+        "method": method,
+        "iterations": iterations,
+        "time": time.perf_counter() - t0,
+        "converged": converged,
+    }
@@ -1,39 +1,120 @@
 """Discretizing AR(1) process using Rouwenhorst method."""
 
+import os
+from collections import OrderedDict
+
 import numpy as np
-from numba import njit
+from numba import njit, prange
+from checkpoint import load_array, replace_atomic
 
 
-@njit
-def rouwenhorst_matrix(n, p):
-    """Compute the transition matrix for the Rouwenhorst method.
+@njit(cache=True)
+def binomial_pmf(k, p, out):
+    """Write the Binomial(k, p) probability mass function into `out` in place.
+
+    The pmf is built outward from the mode with the ratio recurrence and then
+    normalized, so it stays accurate for several thousand trials without
+    evaluating large binomial coefficients.
 
     Parameters
     ----------
-    n: number of states.
+    k: number of trials.
+    p: success probability.
+    out: array of length at least k + 1 (entries beyond k are left untouched).
+
+    Returns
+    -------
+    lo, hi: first and last index of the (numerically) nonzero support.
+    """
+    out[: k + 1] = 0.0
+    if p <= 0.0 or k == 0:
+        out[0] = 1.0
+        return 0, 0
+    if p >= 1.0:
+        out[k] = 1.0
+        return k, k
+
+    odds = p / (1 - p)
+    mode = min(int((k + 1) * p), k)
+    out[mode] = 1.0
+    total = 1.0
+
+    hi = mode
+    while hi < k:  # walk up from the mode until the mass underflows
+        value = out[hi] * (k - hi) / (hi + 1) * odds
+        if value < 1e-300:
+            break
+        hi += 1
+        out[hi] = value
+        total += value
+
+    lo = mode
+    while lo > 0:  # walk down from the mode
+        value = out[lo] * lo / (k - lo + 1) / odds
+        if value < 1e-300:
+            break
+        lo -= 1
+        out[lo] = value
+        total += value
+
+    out[lo : hi + 1] /= total
+    return lo, hi
+
+
+@njit(cache=True)
+def rouwenhorst_fill(Π, p):
+    """Fill a preallocated n * n array with the Rouwenhorst transition matrix.
+
+    Row i is the law of Binomial(i, p) + Binomial(n - 1 - i, 1 - p), so each row
+    is the convolution of two binomial pmfs over their nonzero supports. Only
+    the top half is computed; the rest follows from Π[n-1-i, n-1-j] = Π[i, j].
+
+    Parameters
+    ----------
+    Π: n * n array, overwritten in place.
     p: parameter of the transition matrix.
 
     Returns
     -------
-    Π: transition matrix.
+    Π: the filled transition matrix (same object as the input).
     """
-    Π0 = np.array([[p, 1 - p], [1 - p, p]])
+    n = Π.shape[0]
+    A = np.empty(n)  # pmf of Binomial(i, p)
+    B = np.empty(n)  # pmf of Binomial(n - 1 - i, 1 - p)
 
-    for n in range(3, n + 1):
-        Π = np.zeros((n, n))
+    for i in range((n + 1) // 2):
+        Π[i, :] = 0.0
+        lo_a, hi_a = binomial_pmf(i, p, A)
+        lo_b, hi_b = binomial_pmf(n - 1 - i, 1 - p, B)
+        for ka in range(lo_a, hi_a + 1):
+            for kb in range(lo_b, hi_b + 1):
+                Π[i, ka + kb] += A[ka] * B[kb]
 
-        Π[:-1, :-1] += p * Π0
-        Π[:-1, 1:] += (1 - p) * Π0
-        Π[1:, :-1] += (1 - p) * Π0
-        Π[1:, 1:] += p * Π0
-        # Divide all but the top and bottom rows by two so that the elements in each row sum to one.
-        Π[1:-1, :] /= 2
-        Π0 = Π  # Update Π0 for next iteration.
+    # the Rouwenhorst matrix is centro-symmetric
+    for i in range((n + 1) // 2, n):
+        for j in range(n):
+            Π[i, j] = Π[n - 1 - i, n - 1 - j]
 
     return Π
 
 
-@njit
+@njit(cache=True)
+def rouwenhorst_matrix(n, p):
+    """Compute the transition matrix for the Rouwenhorst method.
+
+    Parameters
+    ----------
+    n: number of states.
+    p: parameter of the transition matrix.
+
+    Returns
+    -------
+    Π: transition matrix.
+    """
+    return rouwenhorst_fill(np.empty((n, n)), p)
+
+
+@njit(cache=True)
 def stationary_markov(Π):
     """Compute the stationary distribution of a Markov chain.
 
@@ -50,7 +131,129 @@ def stationary_markov(Π):
     return π
 
 
-@njit
+@njit(cache=True)
+def rouwenhorst_stationary(n):
+    """Closed-form stationary distribution of an n-state Rouwenhorst chain (Binomial(n - 1, 1/2))."""
+    π = np.empty(n)
+    binomial_pmf(n - 1, 0.5, π)
+    return π
+
+
+@njit(cache=True)
+def power_iteration_dense(Π, π0, tol, max_iter):
+    """Iterate π ← πΠ from π0 until the sup-norm change is below tol.
+
+    Returns
+    -------
+    π: stationary distribution.
+    k: number of iterations (-1 if max_iter is reached without convergence).
+    """
+    π = π0 / np.sum(π0)
+    for k in range(max_iter):
+        π1 = π @ Π
+        π1 /= np.sum(π1)
+        if np.max(np.abs(π1 - π)) < tol:
+            return π1, k + 1
+        π = π1
+    return π, -1
+
+
+@njit(cache=True)
+def power_iteration_csr(indptr, indices, data, π0, tol, max_iter):
+    """Power iteration for a transition matrix given by its CSR arrays (see `power_iteration_dense`)."""
+    n = π0.shape[0]
+    π = π0 / np.sum(π0)
+    π1 = np.empty(n)
+    for k in range(max_iter):
+        π1[:] = 0.0
+        for i in range(n):
+            for idx in range(indptr[i], indptr[i + 1]):
+                π1[indices[idx]] += π[i] * data[idx]
+        π1 /= np.sum(π1)
+        diff = np.max(np.abs(π1 - π))
+        π, π1 = π1, π
+        if diff < tol:
+            return π, k + 1
+    return π, -1
+
+
+def is_rouwenhorst(Π, atol=1e-12):
+    """Check whether a dense transition matrix is a (symmetric) Rouwenhorst matrix."""
+    n = Π.shape[0]
+    if n < 2 or Π[0, 0] <= 0.0:
+        return False
+    p = Π[0, 0] ** (1 / (n - 1))
+    # cheap O(n) test on the first row before building the whole matrix
+    row = np.empty(n)
+    binomial_pmf(n - 1, 1 - p, row)
+    if not np.allclose(Π[0], row, rtol=0.0, atol=atol):
+        return False
+    return np.allclose(Π, rouwenhorst_matrix(n, p), rtol=0.0, atol=atol)
+
+
+def stationary_distribution(Π, method="auto", π0=None, tol=1e-13, max_iter=1_000_000):
+    """Compute the stationary distribution of a Markov chain, choosing the method by input.
+
+    Parameters
+    ----------
+    Π: transition matrix, a dense array or a scipy.sparse matrix.
+    method: "auto", "rouwenhorst" (closed-form binomial law), "power" (power iteration),
+        "sparse" (sparse direct solve) or "dense" (`stationary_markov`).
+        "auto" uses the closed form for Rouwenhorst chains, power iteration for
+        sparse or banded chains when a warm start is given, the sparse solver when
+        it is not, and the dense solve otherwise.
+    π0: optional warm start for power iteration (e.g. π of a nearby calibration).
+    tol: sup-norm tolerance of power iteration.
+    max_iter: maximum number of power iterations.
+
+    Returns
+    -------
+    π: stationary distribution.
+    info: dict with the method that ran and the number of iterations it took.
+    """
+    import scipy.sparse as sp
+
+    if method == "auto":
+        if sp.issparse(Π):
+            method = "sparse" if π0 is None else "power"
+        elif is_rouwenhorst(Π):
+            method = "rouwenhorst"
+        elif Π.shape[0] >= 200 and np.count_nonzero(Π) < 0.1 * Π.size:
+            method = "sparse" if π0 is None else "power"
+        else:
+            method = "dense"
+
+    n = Π.shape[0]
+    n_iter = 0
+    if method == "rouwenhorst":
+        π = rouwenhorst_stationary(n)
+    elif method == "power":
+        π0 = np.full(n, 1 / n) if π0 is None else np.asarray(π0, dtype=np.float64)
+        if sp.issparse(Π) or np.count_nonzero(Π) < 0.1 * Π.size:
+            Π = sp.csr_matrix(Π)
+            π, n_iter = power_iteration_csr(Π.indptr, Π.indices, Π.data, π0, tol, max_iter)
+        else:
+            π, n_iter = power_iteration_dense(np.ascontiguousarray(Π), π0, tol, max_iter)
+        if n_iter < 0:
+            raise ValueError("No converge.")
+    elif method == "sparse":
+        from scipy.sparse.linalg import spsolve
+
+        # replace one (redundant) balance equation by the normalization Σπ = 1
+        A = (sp.identity(n, format="csr") - sp.csr_matrix(Π).T).tocsr()
+        A = sp.vstack([A[:-1], sp.csr_matrix(np.ones((1, n)))], format="csc")
+        b = np.zeros(n)
+        b[-1] = 1.0
+        π = spsolve(A, b)
+    elif method == "dense":
+        π = stationary_markov(np.ascontiguousarray(Π))
+    else:
+        raise ValueError(f"Unknown method: {method}")
+
+    return π, {"method": method, "iterations": n_iter}
+
+
+@njit(cache=True)
 def discretization_ar1(ρ, σ, n):
     """Discretize AR(1) process {z_t} to finite Markov chain {y_t} using Rouwenhorst method.
 
@@ -70,6 +273,236 @@ def discretization_ar1(ρ, σ, n):
     psi = (n - 1) ** 0.5 * σ
     y = np.linspace(-psi, psi, n)
     Π = rouwenhorst_matrix(n, p)
-    π = stationary_markov(Π)
+    π = rouwenhorst_stationary(n)
+
+    return y, Π, π
+
+
+@njit(parallel=True, cache=True)
+def rouwenhorst_fill_batch(Π, p):
+    """Fill a K * n * n array with K Rouwenhorst matrices in parallel (see `rouwenhorst_fill`)."""
+    for k in prange(Π.shape[0]):
+        rouwenhorst_fill(Π[k], p[k])
+    return Π
+
+
+@njit(cache=True)
+def discretization_ar1_batch(ρ, σ, n):
+    """Discretize K AR(1) processes with the same number of states in one kernel.
 
-    return y, Π, π
\ No newline at end of file
+    Parameters
+    ----------
+    ρ: length-K array of persistence parameters.
+    σ: length-K array of standard deviations.
+    n: number of states.
+
+    Returns
+    -------
+    y: K * n array of discretized states.
+    Π: K * n * n array of transition matrices.
+    π: K * n array of stationary distributions.
+    """
+    K = ρ.shape[0]
+    y = np.empty((K, n))
+    π = np.empty((K, n))
+    π_n = rouwenhorst_stationary(n)  # does not depend on (ρ, σ)
+    for k in range(K):
+        psi = (n - 1) ** 0.5 * σ[k]
+        y[k] = np.linspace(-psi, psi, n)
+        π[k] = π_n
+
+    Π = rouwenhorst_fill_batch(np.empty((K, n, n)), (1 + ρ) / 2)
+
+    return y, Π, π
+
+
+# counter-based random numbers: the draw for (seed, stream, counter) is a pure
+# function of its key, so results do not depend on threads or chunking
+_GAMMA = np.uint64(0x9E3779B97F4A7C15)
+
+
+@njit(cache=True)
+def _mix64(x):
+    """SplitMix64 finalizer."""
+    x = (x ^ (x >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    x = (x ^ (x >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return x ^ (x >> np.uint64(31))
+
+
+@njit(cache=True)
+def counter_uniform(seed, stream, counter):
+    """Uniform draw on [0, 1) determined by (seed, stream, counter)."""
+    key = _mix64(np.uint64(seed) * _GAMMA + np.uint64(stream))
+    x = _mix64(key + (np.uint64(counter) + np.uint64(1)) * _GAMMA)
+    return (x >> np.uint64(11)) * (1.0 / 9007199254740992.0)  # 53 random bits
+
+
+def markov_cdf(Π):
+    """Cumulative rows of a transition matrix (last column set to exactly one)."""
+    cdf = np.cumsum(Π, axis=-1)
+    cdf[..., -1] = 1.0
+    return cdf
+
+
+@njit(parallel=True, cache=True)
+def simulate_markov_into(cdf, cdf0, s_prev, t0, seed, out):
+    """Simulate N agents for out.shape[1] periods starting at period t0, in place.
+
+    Agent i uses the random stream (seed, i), and period t uses counter t, so a
+    panel produced in time-chunks equals the one produced in a single call.
+
+    Parameters
+    ----------
+    cdf: cumulative rows of the transition matrix (see `markov_cdf`).
+    cdf0: cumulative initial distribution, used for period 0.
+    s_prev: length-N states at period t0 - 1 (ignored when t0 == 0).
+    t0: period of the first column of out.
+    seed: seed of the random streams.
+    out: N * T integer array of state indices, overwritten.
+    """
+    N, T = out.shape
+    for i in prange(N):
+        s = s_prev[i]
+        for t in range(T):
+            u = counter_uniform(seed, i, t0 + t)
+            row = cdf0 if t0 + t == 0 else cdf[s]
+            s = np.searchsorted(row, u, side="right")
+            out[i, t] = s
+    return out
+
+
+def _state_dtype(n):
+    return np.int16 if n <= np.iinfo(np.int16).max else np.int32
+
+
+def simulate_markov(Π, π, N, T, seed=1234):
+    """Simulate an N * T panel of a Markov chain whose initial states are drawn from π.
+
+    Parameters
+    ----------
+    Π: transition matrix.
+    π: initial (usually stationary) distribution.
+    N: number of agents.
+    T: number of periods.
+    seed: seed of the per-agent random streams.
+
+    Returns
+    -------
+    states: N * T array of state indices (index y with it to get the levels).
+    """
+    n = Π.shape[0]
+    out = np.empty((N, T), dtype=_state_dtype(n))
+    s_prev = np.zeros(N, dtype=out.dtype)
+    return simulate_markov_into(markov_cdf(Π), markov_cdf(π), s_prev, 0, seed, out)
+
+
+def simulate_markov_chunks(Π, π, N, T, chunk=100, seed=1234):
+    """Simulate the same panel as `simulate_markov` without materializing it.
+
+    Yields
+    ------
+    t0: period of the first column of the chunk.
+    states: N * chunk array of state indices for periods t0, t0 + 1, ...
+        (the buffer is reused, so copy it if it has to outlive the iteration).
+    """
+    n = Π.shape[0]
+    cdf, cdf0 = markov_cdf(Π), markov_cdf(π)
+    buffer = np.empty((N, min(chunk, T)), dtype=_state_dtype(n))
+    s_prev = np.zeros(N, dtype=buffer.dtype)
+    for t0 in range(0, T, chunk):
+        out = buffer[:, : min(chunk, T - t0)]
+        simulate_markov_into(cdf, cdf0, s_prev, t0, seed, out)
+        s_prev[:] = out[:, -1]
+        yield t0, out
+
+
+class DiscretizationCache:
+    """LRU cache of `discretization_ar1` results keyed on (ρ, σ, n).
+
+    Cached arrays are returned read-only, so callers must copy before mutating.
+    With `cache_dir`, results are also stored as `.npy` files and reopened as
+    memory maps, so other processes can reuse a chain without rebuilding it.
+
+    Parameters
+    ----------
+    maxsize: number of discretizations kept in memory.
+    cache_dir: optional directory of the on-disk store.
+    mmap_mode: mode used by `np.load` when reading from the on-disk store.
+    """
+
+    def __init__(self, maxsize=128, cache_dir=None, mmap_mode="r"):
+        self.maxsize = maxsize
+        self.cache_dir = cache_dir
+        self.mmap_mode = mmap_mode
+        self.hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        self._store = OrderedDict()
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def __call__(self, ρ, σ, n):
+        key = (float(ρ), float(σ), int(n))
+        if key in self._store:
+            self.hits += 1
+            self._store.move_to_end(key)
+            return self._store[key]
+
+        result = self._load(key)
+        if result is None:
+            self.misses += 1
+            result = discretization_ar1(*key)
+            for x in result:
+                x.flags.writeable = False
+            self._save(key, result)
+        else:
+            self.disk_hits += 1
+
+        self._store[key] = result
+        if len(self._store) > self.maxsize:
+            self._store.popitem(last=False)  # evict the least recently used
+        return result
+
+    def clear(self):
+        """Drop the in-memory entries (the on-disk store is kept)."""
+        self._store.clear()
+
+    def _paths(self, key):
+        ρ, σ, n = key
+        stem = f"rouwenhorst_n{n}_rho{ρ.hex()}_sigma{σ.hex()}"
+        # ASCII suffixes: Π and π would name the same file on case-insensitive filesystems
+        return [os.path.join(self.cache_dir, f"{stem}_{name}.npy") for name in ("y", "P", "pi")]
+
+    def _load(self, key):
+        if self.cache_dir is None:
+            return None
+        paths = self._paths(key)
+        if not all(os.path.exists(path) for path in paths):
+            return None
+        return tuple(load_array(path, self.mmap_mode) for path in paths)
+
+    def _save(self, key, result):
+        if self.cache_dir is None:
+            return
+        for path, x in zip(self._paths(key), result):
+            replace_atomic(path, lambda f: np.save(f, x))
+
+
+# shared cache (set AR1_CACHE_DIR to persist discretizations across processes)
+default_cache = DiscretizationCache(cache_dir=os.environ.get("AR1_CACHE_DIR"))
+
+
+def cached_discretization_ar1(ρ, σ, n):
+    """Memoized `discretization_ar1` backed by `default_cache`.
+
+    Parameters
+    ----------
+    ρ: persistence parameter of {z_t}.
+    σ: standard deviation of z_t.
+    n: number of states.
+
+    Returns
+    -------
+    y, Π, π: read-only arrays, see `discretization_ar1`.
+    """
+    return default_cache(ρ, σ, n)
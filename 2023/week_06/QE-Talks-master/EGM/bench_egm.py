@@ -0,0 +1,380 @@
+"""
+Benchmarks for the EGM solvers.
+
+Run all benchmarks with `python bench_egm.py`, or a single one with e.g.
+`python bench_egm.py egm_step`. Timings exclude the first (compiling) call.
+"""
+import os
+import subprocess
+import sys
+import time
+
+import numba
+import numpy as np
+from numba import njit
+from ar1 import cached_discretization_ar1
+from egm_1d import egm_factory, household, solve_egm, solve_egm_batch
+
+
+def best_time(f, repeat=3):
+    """Best wall time of `repeat` calls of f() (after one warm-up call), and f's result."""
+    result = f()
+    times = []
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - t0)
+    return min(times), result
+
+
+def legacy_egm_factory(β=0.98, r=0.0025, a_min=0.0, a_max=20.0, n_a=100, ρ=0.975, σ=0.5, n_y=20):
+    """The original 1D EGM solver (before loop-invariant hoisting), kept as the baseline."""
+    log_y_grid, Π_y, π_y = cached_discretization_ar1(ρ, σ, n_y)
+    y_grid = np.exp(log_y_grid)
+    a_grid = np.linspace(a_min, a_max, n_a)
+    n_m = n_a
+    m_grid = np.linspace(0.01, a_max, n_m)
+
+    @njit
+    def u_prime(c):
+        return 1 / c
+
+    @njit
+    def u_prime_inv(u):
+        return 1 / u
+
+    @njit
+    def egm_step(p_c0):
+        m1_grid = (1 + r) * a_grid.reshape(-1, 1) + y_grid.reshape(1, -1)
+        c1_grid = np.empty((n_a, n_y))
+        for i in range(n_y):
+            c1_grid[:, i] = np.interp(m1_grid[:, i], m_grid, p_c0[:, i])
+        ex_u_prime_grid = np.empty((n_a, n_y))
+        for i in range(n_a):
+            for j in range(n_y):
+                ex_u_prime_grid[i, j] = np.dot(Π_y[j, :], u_prime(c1_grid[i, :]))
+        c0_grid = u_prime_inv(β * (1 + r) * ex_u_prime_grid)
+        m_y_grid = a_grid.reshape(-1, 1) + c0_grid
+        p_c1 = np.empty((n_m, n_y))
+        for i in range(n_y):
+            p_c1[:, i] = np.minimum(
+                np.interp(m_grid, m_y_grid[:, i], c0_grid[:, i]), m_grid
+            )
+        return p_c1
+
+    @njit
+    def egm(max_iter=10_000_000, tol=1e-9):
+        p_c0 = 0.5 * m_grid.repeat(n_y).reshape(n_m, n_y)
+        for i in range(max_iter):
+            p_c1 = egm_step(p_c0)
+            if np.max(np.abs(p_c1 - p_c0)) < tol:
+                return p_c1
+            p_c0 = p_c1
+        raise ValueError("No converge.")
+
+    return egm
+
+
+def bench_egm_step(n_a=1000, n_y=50, tol=1e-9):
+    """Before/after: full 1D EGM solve with the legacy step vs the current step."""
+    legacy = legacy_egm_factory(n_a=n_a, n_y=n_y)
+    egm, _ = egm_factory(n_a=n_a, n_y=n_y)
+    t_before, p_before = best_time(lambda: legacy(tol=tol))
+    t_after, p_after = best_time(lambda: egm(tol=tol))
+    print(f"egm_step (n_a={n_a}, n_y={n_y}):")
+    print(f"  before: {t_before:8.3f} s")
+    print(f"  after:  {t_after:8.3f} s  ({t_before / t_after:.1f}x)")
+    print(f"  max |Δp_c| = {np.max(np.abs(p_after - p_before)):.2e}")
+
+
+def bench_egm_threads(n_a=2000, n_y=50, tol=1e-9):
+    """Scaling of the parallel 1D EGM solver from 1 to NUMBA_NUM_THREADS threads."""
+    egm_serial, _ = egm_factory(n_a=n_a, n_y=n_y)
+    egm_parallel, _ = egm_factory(n_a=n_a, n_y=n_y, parallel=True)
+    t_serial, p_serial = best_time(lambda: egm_serial(tol=tol))
+    print(f"egm threads (n_a={n_a}, n_y={n_y}):")
+    print(f"  serial:     {t_serial:8.3f} s")
+    n_max = numba.config.NUMBA_NUM_THREADS
+    n_threads = sorted({2**k for k in range(n_max.bit_length()) if 2**k <= n_max} | {n_max})
+    for n in n_threads:
+        t, p = best_time(lambda: egm_parallel(tol=tol, n_threads=n))
+        assert np.array_equal(p, p_serial), "parallel result differs from serial"
+        print(f"  {n:3d} threads: {t:8.3f} s  ({t_serial / t:.1f}x)")
+
+
+def bench_egm_sweep(n_calib=10, n_a=100, n_y=20, tol=1e-9):
+    """Before/after: calibration sweep over r, building a factory and solving per point.
+
+    The legacy factory compiles its closures at every point; the current kernels
+    take the model as an argument and are compiled (or loaded from the disk cache) once.
+    """
+    rs = np.linspace(0.001, 0.01, n_calib)
+    t0 = time.perf_counter()
+    for r in rs:
+        legacy_egm_factory(r=r, n_a=n_a, n_y=n_y)(tol=tol)
+    t_before = time.perf_counter() - t0
+    egm_factory(n_a=n_a, n_y=n_y)[0](tol=tol)  # compile or load from the cache
+    t0 = time.perf_counter()
+    for r in rs:
+        egm_factory(r=r, n_a=n_a, n_y=n_y)[0](tol=tol)
+    t_after = time.perf_counter() - t0
+    print(f"egm sweep ({n_calib} calibrations, n_a={n_a}, n_y={n_y}):")
+    print(f"  before: {t_before:8.3f} s  ({n_calib / t_before:8.1f} solves/s)")
+    print(f"  after:  {t_after:8.3f} s  ({n_calib / t_after:8.1f} solves/s, {t_before / t_after:.0f}x)")
+
+
+def bench_egm_batch(K=32, n_a=300, n_y=20, tol=1e-9, seed=0):
+    """K random calibrations: sequential solves vs one batched solve on all threads."""
+    rng = np.random.default_rng(seed)
+    β, r = rng.uniform(0.95, 0.985, K), rng.uniform(0.0, 0.01, K)
+    ρ, σ = rng.uniform(0.9, 0.98, K), rng.uniform(0.3, 0.8, K)
+
+    def sequential():
+        models = [household(β[k], r[k], 0.0, 20.0, n_a, ρ[k], σ[k], n_y) for k in range(K)]
+        return np.stack([solve_egm(model, tol=tol) for model in models])
+
+    t_before, p_before = best_time(sequential)
+    t_after, p_after = best_time(lambda: solve_egm_batch(β, r, ρ, σ, n_a=n_a, n_y=n_y, tol=tol))
+    assert np.array_equal(p_after, p_before), "batched result differs from sequential"
+    print(f"egm batch (K={K}, n_a={n_a}, n_y={n_y}, {numba.config.NUMBA_NUM_THREADS} threads):")
+    print(f"  sequential: {t_before:8.3f} s")
+    print(f"  batched:    {t_after:8.3f} s  ({t_before / t_after:.1f}x)")
+
+
+def bench_accel(n_a=100, n_y=20, σ=0.7, tol=1e-9, n_3d=(3, 3, 6, 3), tol_3d=1e-6):
+    """Evaluations and wall time of the accelerated fixed-point solvers vs plain iteration.
+
+    1D: the compiled loop and the `accel` solvers on the EGM operator (Newton-Krylov
+    also with scipy's inner solver and line search). 3D: `egm_3d` with each method.
+    """
+    import accel
+    from egm_1d import egm_step
+
+    model = household(n_a=n_a, n_y=n_y, σ=σ)
+    m_grid = model.m_grid.reshape(-1, 1)
+    p_c0 = 0.5 * m_grid.repeat(n_y, axis=1)
+    G = lambda p_c: egm_step(model, np.clip(p_c, 1e-12, m_grid))
+    runs = {
+        "compiled loop": lambda: solve_egm(model, tol=tol, return_info=True),
+        "fixed_point": lambda: accel.fixed_point(G, p_c0, tol),
+        "anderson": lambda: accel.anderson(G, p_c0, tol, memory=5, safeguard=2.0),
+        "newton_krylov": lambda: accel.newton_krylov(G, p_c0, tol),
+        "newton_krylov (scipy)": lambda: accel.newton_krylov(
+            G, p_c0, tol, inner_method="lgmres", inner_maxiter=20, line_search="armijo"
+        ),
+    }
+    print(f"accel 1D (n_a={n_a}, n_y={n_y}, σ={σ}):")
+    for name, run in runs.items():
+        t, (_, info) = best_time(run)
+        print(f"  {name:22s}: {info['iterations']:5d} evaluations, {t:8.3f} s ({info['method']})")
+
+    from egm_3d import egm3d_factory
+
+    n_e, n_q, n_a_3d, n_w = n_3d
+    egm_3d, _ = egm3d_factory(n_a=n_a_3d, n_e=n_e, n_q=n_q, n_w=n_w, σ=0.4, γ=0.3)
+    print(f"accel 3D (n_a={n_a_3d}, n_e={n_e}, n_q={n_q}, n_w={n_w}, rbf):")
+    for method in ("fixed_point", "anderson", "newton_krylov"):
+        t, (_, info) = best_time(lambda: egm_3d(tol=tol_3d, method=method, return_info=True), 1)
+        restarts = f", {info['restarts']} restarts" if "restarts" in info else ""
+        print(
+            f"  {method:22s}: {info['iterations']:5d} evaluations{restarts}, {t:8.3f} s "
+            f"({info['method']})"
+        )
+
+
+def bench_simulate(N=1_000_000, T=50, N_loop=2_000):
+    """Before/after: household panel simulation with Python loops vs `simulate_households`.
+
+    The loop version (per-agent np.interp, as in the notebooks) runs on N_loop
+    agents; both are reported per agent-period.
+    """
+    from ar1 import simulate_markov
+    from simulate import simulate_households
+
+    egm, _ = egm_factory(n_a=500)
+    p_c, model = egm(), egm.model
+
+    def loop():
+        S = simulate_markov(model.Π_y, model.π_y, N_loop, T + 1)
+        m = model.y_grid[S[:, 0]]
+        means = []
+        for t in range(T):
+            c = np.array([np.interp(m[i], model.m_grid, p_c[:, S[i, t]]) for i in range(N_loop)])
+            means.append(m.mean())
+            m = (1 + model.r) * (m - c) + model.y_grid[S[:, t + 1]]
+        return means
+
+    t_before, _ = best_time(loop, repeat=1)
+    t_after, _ = best_time(
+        lambda: simulate_households(p_c, model.m_grid, model.y_grid, model.Π_y, model.r, N, T),
+        repeat=1,
+    )
+    before, after = t_before / (N_loop * T), t_after / (N * T)
+    print(f"simulate (N={N}, T={T}):")
+    print(f"  before: {before * 1e9:8.1f} ns per agent-period")
+    print(f"  after:  {after * 1e9:8.1f} ns per agent-period  ({before / after:.0f}x)")
+
+
+def legacy_euler_step(policy, β=0.98, r=0.1, e_min=0.1, e_max=10, n_e=10, q_min=0.1, q_max=10,
+                      n_q=10, a_min=0.1, a_max=10.0, n_a=20, ρ=0.975, σ=0.5, n_w=5, a1=0.3,
+                      a2=1, b1=0.3, b2=1, γ=0.5):
+    """The original 3D Euler step (one scalar policy call per post decision state and w1)."""
+    log_w_grid, Π_w, _ = cached_discretization_ar1(ρ, σ, n_w)
+    w_grid = np.exp(log_w_grid)
+    e_grid, q_grid = np.linspace(e_min, e_max, n_e), np.linspace(q_min, q_max, n_q)
+    a_grid = np.linspace(a_min, a_max, n_a)
+    F = np.array([[w_i, e, q, a] for w_i in range(n_w) for e in e_grid for q in q_grid for a in a_grid])
+    Φ1, Φ2, Φ3 = a1 / a2, b1 / b2, -1.0
+    L1 = lambda h, l, c: -Φ1 * np.exp(h) - (Φ2 - Φ1) * np.exp(l) + (Φ3 - Φ2) / c
+    L2 = lambda h, l, c: -Φ2 * np.exp(l) + (Φ3 - Φ2) / c
+    L3 = lambda h, l, c: Φ3 / c
+    X1, choices = np.empty_like(F), np.empty((len(F), 3))
+    for i, (w0_index, e1, q1, a0) in enumerate(F):
+        rhs1, rhs2, rhs3 = 0.0, 0.0, 0.0
+        for w1, π in zip(w_grid, Π_w[int(w0_index)]):
+            m1 = (1 + r) * a0 + w1 * (e1 ** (1 - γ)) * (q1**γ)
+            h1, l1, c1 = policy(w1, e1, q1, m1)
+            g1, g2 = w1 * (1 - γ) * (q1 / e1) ** γ, w1 * γ * (e1 / q1) ** (1 - γ)
+            rhs1 += β * a2 * π * (L1(h1, l1, c1) + g1 * L3(h1, l1, c1))
+            rhs2 += β * b2 * π * (L2(h1, l1, c1) + g2 * L3(h1, l1, c1))
+            rhs3 += β * π * (-1) * (1 + r) * L3(h1, l1, c1)
+        h0, l0, c0 = np.maximum([np.log(-rhs1), np.log(-rhs2), 1 / rhs3], 0.0)
+        X1[i] = w_grid[int(w0_index)], (e1 - a2 * h0) / a1, (q1 - b2 * l0) / b1, a0 + c0
+        choices[i] = h0, l0, c0
+    return X1, choices
+
+
+def bench_egm_3d_step(n_a=10, n_e=5, n_q=5, n_w=5, steps=5):
+    """Before/after: one 3D Euler step with scalar policy calls vs the batched step.
+
+    The policy is the global Rbf after `steps` steps from the initial guess.
+    """
+    from egm_3d import egm3d_factory
+    from interpolation import fit_policy
+
+    params = dict(n_a=n_a, n_e=n_e, n_q=n_q, n_w=n_w, σ=0.4, γ=0.3)
+    egm_3d, _ = egm3d_factory(**params)
+    policy = lambda w, e, q, m: (0.01 * e, 0.01 * q, 0.5 * m)
+    for _ in range(steps):
+        policy = fit_policy(*egm_3d.euler_step(policy))
+    t_before, (X1_before, c_before) = best_time(lambda: legacy_euler_step(policy, **params))
+    t_after, (X1_after, c_after) = best_time(lambda: egm_3d.euler_step(policy))
+    print(f"egm_3d_step (N={len(c_after)} post decision states, n_w={n_w}):")
+    print(f"  before: {t_before:8.3f} s")
+    print(f"  after:  {t_after:8.3f} s  ({t_before / t_after:.1f}x)")
+    print(f"  max |Δchoices| = {np.max(np.abs(c_after - c_before)):.2e}")
+
+
+def bench_egm_3d_threads(n_a=8, n_e=4, n_q=4, n_w=3, tol=1e-3, n_max=None):
+    """Scaling of the 3D EGM solve with the threads of its pool (rbf and grid backends)."""
+    from egm_3d import egm3d_factory
+
+    n_max = n_max or os.cpu_count()
+    n_workers = sorted({2**k for k in range(n_max.bit_length()) if 2**k <= n_max} | {n_max})
+    print(f"egm_3d threads (n_a={n_a}, n_e={n_e}, n_q={n_q}, n_w={n_w}):")
+    for interpolation in ("rbf", "grid"):
+        egm_3d, _ = egm3d_factory(
+            n_a=n_a, n_e=n_e, n_q=n_q, n_w=n_w, σ=0.4, γ=0.3, interpolation=interpolation
+        )
+        t_serial = None
+        for n in n_workers:
+            t, _ = best_time(lambda: egm_3d(tol=tol, n_workers=n), repeat=1)
+            t_serial = t_serial or t
+            print(f"  {interpolation:4s} {n:3d} threads: {t:8.3f} s  ({t_serial / t:.1f}x)")
+
+
+def bench_interpolation(sizes=(1_000, 10_000, 100_000), n_query=10_000, n_w=5, seed=0):
+    """Fit and query time of the 3D policy interpolation backends on N scattered points.
+
+    The global "rbf" backend is only run up to 5 000 points (dense O(N^3) fit).
+    """
+    from interpolation import fit_policy
+
+    rng = np.random.default_rng(seed)
+    w_grid = np.exp(np.linspace(-1, 1, n_w))
+    print(f"interpolation ({n_query} queries):")
+    for N in sizes:
+        n = round((N / n_w / 2) ** (1 / 3))  # regular grid with about 2 points per node
+        grid = (w_grid, np.linspace(0, 10, n), np.linspace(0, 10, n), np.linspace(0, 10, n))
+        X1 = np.column_stack([np.repeat(w_grid, N // n_w), rng.uniform(0, 10, (N // n_w * n_w, 3))])
+        choices = np.column_stack([np.sin(X1[:, 1]), np.cos(X1[:, 2]), X1[:, 3] * X1[:, 0]])
+        x = rng.uniform(0, 10, (n_query, 4))
+        x[:, 0] = rng.uniform(w_grid[0], w_grid[-1], n_query)
+        for method in ("rbf", "local_rbf", "grid"):
+            if method == "rbf" and N > 5_000:
+                continue
+            t0 = time.perf_counter()
+            policy = fit_policy(X1, choices, method, grid=grid)
+            t_fit = time.perf_counter() - t0
+            t_query, _ = best_time(lambda: policy(*x.T), repeat=1)
+            print(
+                f"  N={N:7d} {method:9s}: fit {t_fit:8.3f} s, "
+                f"query {t_query / n_query * 1e6:8.2f} us per point"
+            )
+
+
+STARTUP = """
+import sys, time
+t0 = time.perf_counter()
+import {module}
+t1 = time.perf_counter()
+heavy = [m for m in {lazy} if m in sys.modules]
+{first_call}
+print(t1 - t0, time.perf_counter() - t1, ",".join(heavy))
+"""
+
+
+def fresh_startup(module, first_call, lazy):
+    """Import time and first-call time of module in a fresh interpreter.
+
+    Raises AssertionError if importing module imports any of the modules in lazy.
+    """
+    code = STARTUP.format(module=module, first_call=first_call, lazy=tuple(lazy))
+    out = subprocess.run(
+        [sys.executable, "-c", code],
+        cwd=os.path.dirname(os.path.abspath(__file__)),
+        capture_output=True,
+        text=True,
+        check=True,
+    ).stdout.split()
+    assert len(out) == 2, f"importing {module} imports {out[2]}"
+    return float(out[0]), float(out[1])
+
+
+def bench_startup(repeat=2):
+    """Import and first-call times of the solvers in fresh processes (as a batch worker sees them).
+
+    The first run may compile and populate numba's disk cache; later runs load from it.
+    """
+    cases = {
+        "egm_1d": ("egm_1d.egm_factory()[0]()", ["matplotlib", "scipy.interpolate"]),
+        "egm_3d": (
+            "egm_3d.egm3d_factory(n_a=5, n_e=3, n_q=3, n_w=3)[0](tol=1e-3)",
+            ["matplotlib", "scipy.interpolate"],
+        ),
+        "ar1": ("ar1.cached_discretization_ar1(0.975, 0.5, 20)", ["scipy.sparse"]),
+    }
+    print("startup (fresh process):")
+    for module, (first_call, lazy) in cases.items():
+        for i in range(repeat):
+            t_import, t_call = fresh_startup(module, first_call, lazy)
+            print(f"  {module:7s} run {i + 1}: import {t_import:6.3f} s, first call {t_call:6.3f} s")
+
+
+BENCHMARKS = {
+    "egm_step": bench_egm_step,
+    "egm_threads": bench_egm_threads,
+    "egm_sweep": bench_egm_sweep,
+    "egm_batch": bench_egm_batch,
+    "accel": bench_accel,
+    "egm_3d_step": bench_egm_3d_step,
+    "egm_3d_threads": bench_egm_3d_threads,
+    "simulate": bench_simulate,
+    "interpolation": bench_interpolation,
+    "startup": bench_startup,
+}
+
+
+if __name__ == "__main__":
+    for name in sys.argv[1:] or BENCHMARKS:
+        BENCHMARKS[name]()
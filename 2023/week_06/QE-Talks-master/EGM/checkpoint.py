@@ -0,0 +1,98 @@
+"""
+Checkpoints of EGM runs on disk.
+
+A checkpoint is a directory with one .npy file per array and a state.json file
+describing the run (iteration count, convergence, parameters) and naming the
+array files. Every save writes a new generation of array files and then
+replaces state.json atomically, so readers (and resumed runs) always see a
+complete checkpoint, even if the writer is killed halfway. Arrays are read back
+as memory maps, so other processes can use a converged policy without copying
+or re-solving it.
+"""
+import json
+import os
+
+import numpy as np
+
+
+def replace_atomic(path, write):
+    """Create or replace file path with the bytes write(f) writes to a binary file f.
+
+    The data goes to a temporary file first, which is then renamed to path, so
+    concurrent readers never see partial data.
+    """
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as f:
+        write(f)
+    os.replace(tmp, path)
+
+
+def load_array(path, mmap_mode="r"):
+    """Array saved in the .npy file path, memory-mapped with mmap_mode (None to read into memory)."""
+    # np.asarray drops the memmap subclass (zero-copy) so numba accepts the arrays
+    return np.asarray(np.load(path, mmap_mode=mmap_mode))
+
+
+def save_checkpoint(path, arrays, **state):
+    """Save arrays (a dict of name -> array) and JSON-serializable state to directory path."""
+    os.makedirs(path, exist_ok=True)
+    old = read_state(path)
+    generation = 0 if old is None else old["generation"] + 1
+    files = {}
+    for name, x in arrays.items():
+        files[name] = f"{name}.{generation}.npy"
+        replace_atomic(os.path.join(path, files[name]), lambda f: np.save(f, x))
+    state = {**state, "generation": generation, "files": files}
+    replace_atomic(
+        os.path.join(path, "state.json"), lambda f: f.write(json.dumps(state).encode())
+    )
+    # the previous generation is no longer referenced
+    if old is not None:
+        for file in old["files"].values():
+            if file not in files.values():
+                try:
+                    os.remove(os.path.join(path, file))
+                except FileNotFoundError:
+                    pass
+
+
+def read_state(path):
+    """State of the checkpoint in directory path, or None if there is none."""
+    try:
+        with open(os.path.join(path, "state.json")) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+def load_checkpoint(path, mmap_mode="r"):
+    """Arrays and state of the checkpoint in directory path, or None if there is none.
+
+    Returns
+    -------
+    arrays: dict of name -> array, memory-mapped with mmap_mode (None to read into memory).
+    state: dict saved with the arrays.
+    """
+    state = read_state(path)
+    if state is None:
+        return None
+    arrays = {
+        name: load_array(os.path.join(path, file), mmap_mode)
+        for name, file in state["files"].items()
+    }
+    return arrays, state
+
+
+def load_policy(path, name="p_c", converged=True):
+    """Read-only memory map of the policy array saved in a checkpoint, without copying.
+
+    Raises ValueError if there is no checkpoint, or if converged is True and the
+    run that wrote it has not converged.
+    """
+    result = load_checkpoint(path)
+    if result is None:
+        raise ValueError(f"No checkpoint in {path}.")
+    arrays, state = result
+    if converged and not state.get("converged", False):
+        raise ValueError(f"The checkpoint in {path} has not converged.")
+    return arrays[name]
@@ -0,0 +1,163 @@
+"""
+Non-stochastic (histogram) simulation of the 1D household problem, after Young (2010).
+
+The cross-sectional distribution lives on the (m, y) nodes of the EGM solution.
+One period moves mass in three steps:
+1. savings a' = m - c(m, y) are split between the two neighboring a_grid points
+   (a lottery that preserves the mean),
+2. income moves from y to y' with Π_y,
+3. next period's wealth m' = (1 + r) a' + y' is split between the two neighboring
+   m_grid points.
+Steps 1 and 3 have two entries per node, so the operator is stored in O(n_a·n_y).
+"""
+import time
+
+import numpy as np
+from numba import njit
+from ar1 import stationary_distribution
+from egm_1d import interp_brackets
+
+
+def savings_lottery(model, p_c):
+    """Lottery of end-of-period assets a' = m - c(m, y) on a_grid.
+
+    Returns
+    -------
+    a_idx: index of the lower a_grid point of each (m, y) node.
+    a_w: probability of the upper point.
+    """
+    a1 = model.m_grid.reshape(-1, 1) - p_c
+    return interp_brackets(a1, model.a_grid)
+
+
+@njit(cache=True)
+def forward_step(D, a_idx, a_w, Π_y, m1_idx, m1_w, D_a, D_y, out):
+    """Push the distribution D on (m, y) nodes forward one period, into out.
+
+    D_a and D_y are (n_a, n_y) scratch arrays. Returns the sup-norm change of D.
+    """
+    n_m, n_y = D.shape
+    n_a = D_a.shape[0]
+    # (m, y) -> (a', y): savings lottery
+    D_a[:] = 0.0
+    for i in range(n_m):
+        for j in range(n_y):
+            l, w = a_idx[i, j], a_w[i, j]
+            D_a[l, j] += (1 - w) * D[i, j]
+            D_a[l + 1, j] += w * D[i, j]
+    # (a', y) -> (a', y'): income transition
+    np.dot(D_a, Π_y, D_y)
+    # (a', y') -> (m', y'): wealth lottery (brackets of m' from the EGM step)
+    out[:] = 0.0
+    for l in range(n_a):
+        for k in range(n_y):
+            i, w = m1_idx[l, k], m1_w[l, k]
+            out[i, k] += (1 - w) * D_y[l, k]
+            out[i + 1, k] += w * D_y[l, k]
+    diff = 0.0
+    for i in range(n_m):
+        for j in range(n_y):
+            diff = max(diff, abs(out[i, j] - D[i, j]))
+    return diff
+
+
+@njit(cache=True)
+def iterate_distribution(D0, a_idx, a_w, Π_y, m1_idx, m1_w, tol, max_iter):
+    """Iterate forward_step from D0 until the sup-norm change is below tol.
+
+    Returns
+    -------
+    D: stationary distribution on (m, y) nodes.
+    n_iter: number of iterations, or -1 if max_iter is reached.
+    """
+    n_a, n_y = m1_idx.shape
+    D_a, D_y = np.empty((n_a, n_y)), np.empty((n_a, n_y))
+    D0, D1 = D0.copy(), np.empty_like(D0)
+    for it in range(max_iter):
+        if forward_step(D0, a_idx, a_w, Π_y, m1_idx, m1_w, D_a, D_y, D1) < tol:
+            return D1, it + 1
+        D0, D1 = D1, D0
+    return D0, -1
+
+
+def transition_operator(model, p_c):
+    """Sparse transition matrix of the distribution on (m, y) nodes (flattened in C order).
+
+    Built as the product of the savings lottery, the income transition and the
+    wealth lottery; returns a scipy.sparse csr matrix.
+    """
+    import scipy.sparse as sp
+
+    n_a, n_y = model.m1_idx.shape
+    n_m = len(model.m_grid)
+    a_idx, a_w = savings_lottery(model, p_c)
+
+    # (m, y) -> (a', y)
+    rows = np.arange(n_m * n_y).repeat(2)
+    j = np.tile(np.arange(n_y), n_m).repeat(2)
+    cols = (np.stack([a_idx, a_idx + 1], axis=-1).ravel()) * n_y + j
+    vals = np.stack([1 - a_w, a_w], axis=-1).ravel()
+    L_a = sp.csr_matrix((vals, (rows, cols)), shape=(n_m * n_y, n_a * n_y))
+    # (a', y) -> (a', y')
+    P_y = sp.kron(sp.identity(n_a, format="csr"), sp.csr_matrix(model.Π_y), format="csr")
+    # (a', y') -> (m', y')
+    rows = np.arange(n_a * n_y).repeat(2)
+    k = np.tile(np.arange(n_y), n_a).repeat(2)
+    cols = (np.stack([model.m1_idx, model.m1_idx + 1], axis=-1).ravel()) * n_y + k
+    vals = np.stack([1 - model.m1_w, model.m1_w], axis=-1).ravel()
+    L_m = sp.csr_matrix((vals, (rows, cols)), shape=(n_a * n_y, n_m * n_y))
+
+    return (L_a @ P_y @ L_m).tocsr()
+
+
+def stationary_wealth(
+    model, p_c, method="iterate", D0=None, tol=1e-12, max_iter=1_000_000, details=False
+):
+    """Stationary distribution over (m, y) nodes implied by a 1D EGM policy.
+
+    Parameters
+    ----------
+    model: Household of the policy (e.g. `egm.model` of an `egm_factory` solver).
+    p_c: consumption policy on (m, y) grids.
+    method: "iterate" (forward iteration of the factored operator, which can be
+        warm started from D0) or "direct" (sparse solve on `transition_operator`).
+    D0: initial distribution on (m, y) nodes for "iterate" (the income stationary
+        distribution at the lowest wealth by default).
+    tol: sup-norm tolerance of forward iteration.
+    max_iter: maximum number of forward iterations.
+    details: print the time, the iterations and the aggregates.
+
+    Returns
+    -------
+    D: stationary mass on (m, y) nodes.
+    A: aggregate end-of-period assets.
+    C: aggregate consumption.
+    """
+    t0 = time.perf_counter()
+    if method == "iterate":
+        if D0 is None:
+            D0 = np.zeros_like(p_c)
+            D0[0] = model.π_y
+        a_idx, a_w = savings_lottery(model, p_c)
+        D, n_iter = iterate_distribution(
+            np.asarray(D0, dtype=np.float64), a_idx, a_w, model.Π_y,
+            model.m1_idx, model.m1_w, tol, max_iter,
+        )
+        if n_iter < 0:
+            raise ValueError("No converge.")
+    elif method == "direct":
+        π, _ = stationary_distribution(transition_operator(model, p_c), method="sparse")
+        D = np.maximum(π, 0.0).reshape(p_c.shape)
+        n_iter = 0
+    else:
+        raise ValueError(f"Unknown method: {method}")
+
+    D = D / D.sum()
+    A = np.sum(D * (model.m_grid.reshape(-1, 1) - p_c))
+    C = np.sum(D * p_c)
+    if details == True:
+        print(
+            f"Stationary distribution in {time.perf_counter() - t0:.3f} s "
+            f"({method}, {n_iter} iterations): A = {A:.6f}, C = {C:.6f}."
+        )
+    return D, A, C
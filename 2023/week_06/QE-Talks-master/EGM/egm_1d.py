@@ -1,11 +1,563 @@
 """
 EGM algorithm for solving the consumption-savings problem.
 """
+import time
+import types
+from collections import namedtuple
+
 import numpy as np
-import matplotlib as mpl
-import matplotlib.pyplot as plt
-from numba import njit
-from ar1 import discretization_ar1
+import numba
+from numba import njit, prange
+import accel
+from checkpoint import load_checkpoint, save_checkpoint
+from ar1 import cached_discretization_ar1, discretization_ar1_batch
+
+
+def interp_brackets(x, xp):
+    """Precompute np.interp(x, xp, ·) for fixed query points x and knots xp.
+
+    The result is a sparse interpolation operator with two entries per query
+    point: np.interp(x, xp, fp) == (1 - w) * fp[idx] + w * fp[idx + 1]
+    for any fp (up to rounding), including the flat extrapolation at both ends.
+
+    Parameters
+    ----------
+    x: query points (any shape).
+    xp: increasing knots.
+
+    Returns
+    -------
+    idx: index of the left knot of each bracket (same shape as x).
+    w: weight of the right knot (same shape as x).
+    """
+    idx = np.clip(np.searchsorted(xp, x, side="right") - 1, 0, len(xp) - 2)
+    w = np.clip((x - xp[idx]) / (xp[idx + 1] - xp[idx]), 0.0, 1.0)
+    return idx, w
+
+
+@njit(cache=True)
+def interp_sorted(x, xp, fp, out):
+    """np.interp for increasing query points x, as a single merge scan in O(len(x) + len(xp)).
+
+    Parameters
+    ----------
+    x: increasing query points.
+    xp: increasing knots.
+    fp: values at the knots.
+    out: output array of the same length as x.
+    """
+    n = xp.shape[0]
+    j = 0
+    for k in range(x.shape[0]):
+        xk = x[k]
+        if xk <= xp[0]:
+            out[k] = fp[0]
+        elif xk >= xp[n - 1]:
+            out[k] = fp[n - 1]
+        else:
+            while xp[j + 1] <= xk:  # advance to the bracket xp[j] <= xk < xp[j + 1]
+                j += 1
+            out[k] = fp[j] + (fp[j + 1] - fp[j]) / (xp[j + 1] - xp[j]) * (xk - xp[j])
+    return out
+
+
+def regrid_policy(p_c, m_from, m_to):
+    """Linearly interpolate a policy on (m_from, y) grids to (m_to, y) grids."""
+    return np.column_stack([np.interp(m_to, m_from, p_c[:, i]) for i in range(p_c.shape[1])])
+
+
+@njit(cache=True)
+def egm_workspace(n_a, n_y):
+    """Preallocated arrays of the 1D EGM solver: two policy buffers and the step's scratch arrays."""
+    return (
+        np.empty((n_a, n_y)),  # policy buffers on (m, y) grids (n_m = n_a)
+        np.empty((n_a, n_y)),
+        np.empty((n_a, n_y)),  # u'(c(m', y)) on (a, y) grids
+        np.empty((n_a, n_y)),  # E[u'(c(m', y))], then c on (a, y) grids
+        np.empty((n_y, n_a)),  # endogenous m grid of each income state
+        np.empty(n_y),  # sup-norm change of each income state
+    )
+
+
+Household = namedtuple(
+    "Household",
+    ["β", "r", "a_min", "a_max", "ρ", "σ", "a_grid", "m_grid", "y_grid", "Π_y", "π_y",
+     "m1_idx", "m1_w", "Π_y_T", "βR"],
+)
+Household.__doc__ = """Primitives of the household problem and the loop invariants of the EGM step.
+
+The compiled kernels take a Household as an argument instead of closing over its
+arrays, so they are compiled once per process (and cached to disk) for all models.
+"""
+
+
+def household(β=0.98, r=0.0025, a_min=0.0, a_max=20.0, n_a=100, ρ=0.975, σ=0.5, n_y=20):
+    """Household problem with the parameters of `egm_factory`."""
+    # discretize AR(1) process for income
+    # log_y_grid: grid points for log income
+    # Π_y: transition matrix for income
+    # π_y: stationary distribution for income
+    log_y_grid, Π_y, π_y = cached_discretization_ar1(ρ, σ, n_y)
+    y_grid = np.exp(log_y_grid)  # labor supply grid
+    # end-of-period wealth grid
+    a_grid = np.linspace(a_min, a_max, n_a)
+    # number of wealth grids is same as end-of-period wealth grid
+    m_grid = np.linspace(0.01, a_max, n_a)  # wealth is always greater than 0
+
+    # loop invariants of the EGM step
+    # m' on (a, y) grids
+    m1_grid = (1 + r) * a_grid.reshape(-1, 1) + y_grid.reshape(1, -1)
+    # brackets of m' in m_grid, so c(m', y) is a weighted gather of the policy
+    m1_idx, m1_w = interp_brackets(m1_grid, m_grid)
+    Π_y_T = np.ascontiguousarray(Π_y.T)  # E[x(y') | y] on (a, y) grids is x @ Π_y.T
+    return Household(
+        float(β), float(r), float(a_min), float(a_max), float(ρ), float(σ),
+        a_grid, m_grid, y_grid, Π_y, π_y, m1_idx, m1_w, Π_y_T, float(β * (1 + r)),
+    )
+
+
+@njit(cache=True)
+def u(c):
+    """Utility function."""
+    return np.log(c)
+
+
+@njit(cache=True)
+def u_prime(c):
+    """Derivative of utility function."""
+    return 1 / c
+
+
+@njit(cache=True)
+def u_prime_inv(u):
+    """Inverse of derivative of utility function."""
+    return 1 / u
+
+
+def _egm_step_into(model, p_c0, out, workspace):
+    """Iterate policy function based on FOC and envelop condition, without allocating.
+
+    Parameters
+    ----------
+    model : Household.
+    p_c0 : initial consumption policy on (m, y) grids.
+    out : array receiving the updated consumption policy on (m, y) grids.
+    workspace : scratch arrays from `egm_workspace(n_a, n_y)`.
+
+    Returns
+    -------
+    diff : sup-norm distance between the updated and the initial policy.
+    """
+    a_grid, m_grid, m1_idx, m1_w = model.a_grid, model.m_grid, model.m1_idx, model.m1_w
+    n_a, n_y = m1_idx.shape
+    n_m = m_grid.shape[0]
+    _, _, u1_grid, c0_grid, m_y_grid, diff = workspace
+
+    # u'(c(m', y)) on (a, y) grids
+    for i in prange(n_a):
+        for j in range(n_y):
+            k, w = m1_idx[i, j], m1_w[i, j]
+            u1_grid[i, j] = u_prime((1 - w) * p_c0[k, j] + w * p_c0[k + 1, j])
+
+    # E[u'(c(m', y))] on (a, y) grids as a single matrix product
+    np.dot(u1_grid, model.Π_y_T, c0_grid)
+
+    # updated consumption policy on (a, y) grids
+    for i in prange(n_a):
+        for j in range(n_y):
+            c0_grid[i, j] = u_prime_inv(model.βR * c0_grid[i, j])
+
+    for j in prange(n_y):
+        # endogenous m grid for income y_j
+        m_y = m_y_grid[j]
+        for i in range(n_a):
+            m_y[i] = a_grid[i] + c0_grid[i, j]
+        # updated consumption policy on m grid
+        # (m_y is increasing in a, so the interpolation is a merge scan)
+        interp_sorted(m_grid, m_y, c0_grid[:, j], out[:, j])
+        diff[j] = 0.0
+        for i in range(n_m):
+            # handle corner solution (borrowing constraint: consumption cannot exceed wealth)
+            out[i, j] = min(out[i, j], m_grid[i])
+            diff[j] = max(diff[j], abs(out[i, j] - p_c0[i, j]))
+
+    return np.max(diff)
+
+
+def _renamed(f, suffix):
+    """Copy of function f under another name.
+
+    numba's disk cache is keyed on the function's qualified name, not on the
+    compilation options, so each variant of a kernel needs a name of its own.
+    """
+    g = types.FunctionType(f.__code__, f.__globals__, f.__name__ + suffix, f.__defaults__)
+    g.__qualname__ = f.__qualname__ + suffix
+    g.__doc__ = f.__doc__
+    return g
+
+
+# prange is a plain range in the serial kernel
+egm_step_into = njit(cache=True)(_egm_step_into)
+egm_step_into_parallel = njit(parallel=True, cache=True)(_renamed(_egm_step_into, "_parallel"))
+
+
+@njit(cache=True)
+def egm_step(model, p_c0):
+    """Iterate policy function based on FOC and envelop condition.
+
+    Parameters
+    ----------
+    model : Household.
+    p_c0 : initial consumption policy on (m, y) grids.
+
+    Returns
+    -------
+    p_c1 : updated consumption policy on (m, y) grids.
+    """
+    n_a, n_y = model.m1_idx.shape
+    p_c1 = np.empty((model.m_grid.shape[0], n_y))
+    egm_step_into(model, p_c0, p_c1, egm_workspace(n_a, n_y))
+    return p_c1
+
+
+@njit(cache=True)
+def egm_iterate(model, workspace, max_iter, tol, parallel):
+    """Iterate from the policy in workspace[0], swapping the two policy buffers.
+
+    Returns
+    -------
+    p_c: converged policy (one of the two workspace buffers).
+    n_iter: number of iterations, or -1 if max_iter is reached.
+    """
+    p_c0, p_c1 = workspace[0], workspace[1]
+    for i in range(max_iter):
+        if parallel:
+            diff = egm_step_into_parallel(model, p_c0, p_c1, workspace)
+        else:
+            diff = egm_step_into(model, p_c0, p_c1, workspace)
+        if diff < tol:
+            return p_c1, i + 1
+        p_c0, p_c1 = p_c1, p_c0
+    return p_c0, -1
+
+
+def solve_egm(
+    model,
+    max_iter=10_000_000,
+    tol=1e-9,
+    details=False,
+    workspace=None,
+    n_threads=None,
+    method="fixed_point",
+    memory=5,
+    return_info=False,
+    p_c0=None,
+    grid_levels=None,
+    parallel=False,
+    checkpoint=None,
+    checkpoint_every=1_000,
+):
+    """Solve the consumption policy function of a Household using EGM.
+
+    Parameters
+    ----------
+    model: Household, e.g. from `household(...)`.
+    tol: tolerance for convergence.
+    max_iter: maximum number of iterations.
+    workspace: optional `egm_workspace(n_a, n_y)`, reused across solves of the same size.
+    n_threads: number of numba threads used by the parallel kernel (all by default).
+    method: "fixed_point" (successive approximation), "anderson" (Anderson mixing of the
+        last `memory` iterates) or "newton_krylov" (Newton-Krylov on the residual
+        T(p_c) - p_c). The accelerated methods fall back to successive approximation.
+        They need fewer evaluations of the EGM operator but, as each goes through
+        Python, take longer than the compiled plain loop on small grids (see
+        `accel.newton_krylov`).
+    memory: memory of Anderson mixing.
+    return_info: also return a dict with the method, the iteration count and the time.
+    p_c0: initial policy on this problem's (m, y) grids (consume 50% of wealth by default).
+    grid_levels: increasing numbers of wealth grid points of coarser problems. Each
+        level is solved from the interpolated solution of the previous one, and
+        the last level's solution is interpolated to start this grid (only the
+        solve on this grid is checkpointed).
+    parallel: use the kernel with parallel loops over asset points and income states
+        (results are identical to the serial kernel).
+    checkpoint: optional directory of a checkpoint (see `checkpoint.py`). The solve
+        resumes from the policy saved there, or returns it if that run converged
+        with the same tolerance; successive approximation saves the policy every
+        `checkpoint_every` iterations and the solution at the end.
+    checkpoint_every: number of iterations between checkpoints.
+
+    Returns
+    -------
+    p_c: nz * na grids of consumption policy function.
+    """
+    m_grid = model.m_grid
+    n_a, n_y = model.m1_idx.shape
+    n_m = len(m_grid)
+    step_into = egm_step_into_parallel if parallel else egm_step_into
+
+    n_done = 0  # iterations of the run that wrote the checkpoint
+    if checkpoint is not None:
+        params = {
+            "β": model.β, "r": model.r, "a_min": model.a_min, "a_max": model.a_max,
+            "ρ": model.ρ, "σ": model.σ, "n_a": n_a, "n_y": n_y,
+        }
+        saved = load_checkpoint(checkpoint, mmap_mode=None)
+        if saved is not None:
+            arrays, state = saved
+            if state["params"] != params:
+                raise ValueError(f"The checkpoint in {checkpoint} is of another model.")
+            n_done = state["iterations"]
+            if state["converged"] and state["tol"] <= tol:
+                info = {
+                    "method": "checkpoint",
+                    "iterations": n_done,
+                    "time": 0.0,
+                    "converged": True,
+                }
+                return (arrays["p_c"], info) if return_info else arrays["p_c"]
+            p_c0, grid_levels = arrays["p_c"], None
+
+        def save(p_c, iterations, converged):
+            save_checkpoint(
+                checkpoint, {"p_c": p_c}, params=params, tol=tol,
+                iterations=iterations, converged=converged,
+            )
+
+    if grid_levels:
+        # grid continuation: solve coarse problems first and warm start from them
+        t0 = time.perf_counter()
+        options = dict(
+            max_iter=max_iter, tol=tol, n_threads=n_threads, method=method, memory=memory,
+            return_info=True, parallel=parallel,
+        )
+        p_c, m_from, levels = p_c0, m_grid, []
+        for n in grid_levels:
+            model_n = household(
+                model.β, model.r, model.a_min, model.a_max, n, model.ρ, model.σ, n_y
+            )
+            p_c_n = None if p_c is None else regrid_policy(p_c, m_from, model_n.m_grid)
+            p_c, info = solve_egm(model_n, **options, p_c0=p_c_n)
+            m_from = model_n.m_grid
+            levels.append(info)
+        p_c, info = solve_egm(
+            model, **options, workspace=workspace, p_c0=regrid_policy(p_c, m_from, m_grid),
+            checkpoint=checkpoint, checkpoint_every=checkpoint_every,
+        )
+        info["levels"] = levels
+        info["time"] = time.perf_counter() - t0
+        if details == True:
+            print(
+                f"Converged in {info['iterations']} iterations on the finest grid after "
+                f"{[level['iterations'] for level in levels]} on coarser grids "
+                f"({info['time']:.3f} s, {info['method']})."
+            )
+        return (p_c, info) if return_info else p_c
+
+    if workspace is None:
+        workspace = egm_workspace(n_a, n_y)
+
+    def iterate(G, p_c0, tol):
+        """Compiled successive approximation from p_c0 (G is the EGM operator)."""
+        t0 = time.perf_counter()
+        workspace[0][:] = p_c0
+        block = max_iter if checkpoint is None else checkpoint_every
+        iterations = 0
+        while True:
+            # run in blocks of checkpoint_every iterations, saving the policy in between
+            n = min(block, max_iter - iterations)
+            p_c, n_iter = egm_iterate(model, workspace, n, tol, parallel)
+            iterations += n_iter if n_iter > 0 else n
+            if n_iter > 0 or iterations >= max_iter:
+                break
+            workspace[0][:] = p_c
+            save(p_c, n_done + iterations, False)
+        info = {
+            "method": "fixed_point",
+            "iterations": iterations,
+            "time": time.perf_counter() - t0,
+            "converged": n_iter > 0,
+        }
+        if checkpoint is not None and n_iter < 0:
+            save(p_c, n_done + iterations, False)
+        return p_c.copy(), info  # the workspace buffers are overwritten by the next solve
+
+    def T(p_c0):
+        """EGM operator; extrapolated guesses are first projected onto 0 < c <= m."""
+        p_c1 = np.empty((n_m, n_y))
+        step_into(model, np.clip(p_c0, 1e-12, m_grid.reshape(-1, 1)), p_c1, workspace)
+        return p_c1
+
+    if p_c0 is None:
+        # initial guess of consumption policy (consume 50% of wealth)
+        p_c0 = 0.5 * m_grid.repeat(n_y).reshape(n_m, n_y)
+    threads = numba.get_num_threads()
+    numba.set_num_threads(n_threads or numba.config.NUMBA_NUM_THREADS)
+    try:
+        if method == "fixed_point":
+            p_c, info = iterate(T, p_c0, tol)
+        elif method == "anderson":
+            # (the 1D operator is monotone, so some growth of the residual is tolerated)
+            p_c, info = accel.anderson(
+                T, p_c0, tol, max_iter, memory=memory, safeguard=2.0, fallback=iterate
+            )
+        elif method == "newton_krylov":
+            p_c, info = accel.newton_krylov(T, p_c0, tol, fallback=iterate)
+        else:
+            raise ValueError(f"Unknown method: {method}")
+    finally:
+        numba.set_num_threads(threads)
+
+    if not info["converged"]:
+        raise ValueError("No converge.")
+    if checkpoint is not None:
+        save(p_c, n_done + info["iterations"], True)
+    if details == True:
+        print(
+            f"Converged in {info['iterations']} iterations "
+            f"({info['time']:.3f} s, {info['method']})."
+        )
+    return (p_c, info) if return_info else p_c
+
+
+def household_batch(β=0.98, r=0.0025, ρ=0.975, σ=0.5, a_min=0.0, a_max=20.0, n_a=100, n_y=20):
+    """K household problems stacked along a leading calibration axis.
+
+    β, r, ρ and σ are scalars or length-K arrays (broadcast against each other);
+    the wealth grids are shared. The result is a Household whose per-model
+    fields (β, r, ρ, σ, βR and the income and bracket arrays) have a leading
+    axis of length K; `household_batch(...)` entry k matches `household(...)`
+    at the k-th parameters.
+    """
+    β, r, ρ, σ = (np.ascontiguousarray(x, dtype=np.float64) for x in np.broadcast_arrays(
+        *(np.atleast_1d(x) for x in (β, r, ρ, σ))
+    ))
+    log_y_grid, Π_y, π_y = discretization_ar1_batch(ρ, σ, n_y)
+    y_grid = np.exp(log_y_grid)
+    a_grid = np.linspace(a_min, a_max, n_a)
+    m_grid = np.linspace(0.01, a_max, n_a)
+    m1_grid = (1 + r).reshape(-1, 1, 1) * a_grid.reshape(1, -1, 1) + y_grid.reshape(-1, 1, n_y)
+    m1_idx, m1_w = interp_brackets(m1_grid, m_grid)
+    Π_y_T = np.ascontiguousarray(Π_y.transpose(0, 2, 1))
+    return Household(
+        β, r, float(a_min), float(a_max), ρ, σ,
+        a_grid, m_grid, y_grid, Π_y, π_y, m1_idx, m1_w, Π_y_T, β * (1 + r),
+    )
+
+
+@njit(cache=True)
+def batch_member(batch, k):
+    """The k-th Household of a `household_batch` (views, no copies)."""
+    return Household(
+        batch.β[k], batch.r[k], batch.a_min, batch.a_max, batch.ρ[k], batch.σ[k],
+        batch.a_grid, batch.m_grid, batch.y_grid[k], batch.Π_y[k], batch.π_y[k],
+        batch.m1_idx[k], batch.m1_w[k], batch.Π_y_T[k], batch.βR[k],
+    )
+
+
+@njit(parallel=True, cache=True)
+def egm_iterate_batch(batch, p_c, tol, max_iter):
+    """Iterate all models of a batch at once, in place on p_c (K * n_m * n_y).
+
+    Each sweep steps the active models in parallel (one model per thread) and
+    then drops the converged ones from the active set.
+
+    Returns
+    -------
+    n_iter: iterations of each model, -1 for models that reached max_iter.
+    """
+    K, n_m, n_y = p_c.shape
+    n_a = batch.a_grid.shape[0]
+    p_c1 = np.empty_like(p_c)
+    u1_grid = np.empty((K, n_a, n_y))
+    c0_grid = np.empty((K, n_a, n_y))
+    m_y_grid = np.empty((K, n_y, n_a))
+    diff = np.empty((K, n_y))
+    n_iter = np.full(K, -1)
+    # active models are active[:n_active]; the buffer is compacted in place, since
+    # rebinding an array used by a prange loop inside another loop is miscompiled
+    active = np.arange(K)
+    n_active = K
+    for it in range(max_iter):
+        for t in prange(n_active):
+            k = active[t]
+            workspace = (p_c[k], p_c1[k], u1_grid[k], c0_grid[k], m_y_grid[k], diff[k])
+            # the two policy buffers swap roles every sweep
+            if it % 2 == 0:
+                d = egm_step_into(batch_member(batch, k), p_c[k], p_c1[k], workspace)
+            else:
+                d = egm_step_into(batch_member(batch, k), p_c1[k], p_c[k], workspace)
+            if d < tol:
+                n_iter[k] = it + 1
+        n = 0
+        for t in range(n_active):
+            if n_iter[active[t]] < 0:
+                active[n] = active[t]
+                n += 1
+        n_active = n
+        if n_active == 0:
+            break
+    for k in prange(K):
+        if (n_iter[k] if n_iter[k] > 0 else max_iter) % 2 == 1:  # last step wrote p_c1
+            p_c[k][:] = p_c1[k]
+    return n_iter
+
+
+def solve_egm_batch(
+    β=0.98,
+    r=0.0025,
+    ρ=0.975,
+    σ=0.5,
+    a_min=0.0,
+    a_max=20.0,
+    n_a=100,
+    n_y=20,
+    max_iter=10_000_000,
+    tol=1e-9,
+    details=False,
+    n_threads=None,
+    p_c0=None,
+    return_info=False,
+):
+    """Solve the consumption policies of K calibrations together.
+
+    Parameters
+    ----------
+    β, r, ρ, σ: scalars or length-K arrays of parameters (see `egm_factory`).
+    a_min, a_max, n_a, n_y: grids shared by all calibrations.
+    tol: tolerance for convergence of each model.
+    max_iter: maximum number of iterations.
+    n_threads: number of numba threads (all by default).
+    p_c0: initial policies, K * n_m * n_y (consume 50% of wealth by default).
+    return_info: also return a dict with the iterations of each model and the time.
+
+    Returns
+    -------
+    p_c: K * n_m * n_y consumption policies.
+    """
+    t0 = time.perf_counter()
+    batch = household_batch(β, r, ρ, σ, a_min, a_max, n_a, n_y)
+    K = len(batch.β)
+    if p_c0 is None:
+        p_c = np.tile(0.5 * batch.m_grid.reshape(1, -1, 1), (K, 1, n_y))
+    else:
+        p_c = np.array(p_c0, dtype=np.float64)
+    threads = numba.get_num_threads()
+    numba.set_num_threads(n_threads or numba.config.NUMBA_NUM_THREADS)
+    try:
+        n_iter = egm_iterate_batch(batch, p_c, tol, max_iter)
+    finally:
+        numba.set_num_threads(threads)
+
+    if np.any(n_iter < 0):
+        raise ValueError(f"No converge: models {np.flatnonzero(n_iter < 0)}.")
+    info = {"iterations": n_iter, "time": time.perf_counter() - t0}
+    if details == True:
+        print(
+            f"Converged {K} models in {n_iter.min()}-{n_iter.max()} iterations "
+            f"({info['time']:.3f} s)."
+        )
+    return (p_c, info) if return_info else p_c
 
 
 def egm_factory(
@@ -17,9 +569,13 @@ def egm_factory(
     ρ=0.975,
     σ=0.5,
     n_y=20,
+    parallel=False,
 ):
     """Factory of functions for the household problem.
 
+    The solver is `solve_egm` bound to `household(...)`; no compilation happens
+    here, so factories are cheap to build in calibration loops.
+
     Parameters:
     -----------
     β: discount factor.
@@ -30,112 +586,29 @@ def egm_factory(
     ρ: AR(1) coefficient for log income.
     σ: standard deviation of log income.
     n_y: number of points in income grid.
+    parallel: use the EGM step with parallel loops over asset points and income states
+        (results are identical to the serial step).
 
     Returns:
     --------
-    egm: EGM solver for household's consumption policy function.
+    egm: EGM solver for household's consumption policy function (see `solve_egm`).
     draw_plot: a function which draws 2-d and 3-d plots of the consumption policy function.
     """
-    # discretize AR(1) process for income
-    # log_y_grid: grid points for log income
-    # Π_y: transition matrix for income
-    # π_y: stationary distribution for income
-    log_y_grid, Π_y, π_y = discretization_ar1(ρ, σ, n_y)
-    y_grid = np.exp(log_y_grid)  # labor supply grid
-    # end-of-period wealth grid
-    a_grid = np.linspace(a_min, a_max, n_a)
-    # number of wealth grids is same as end-of-period wealth grid
-    n_m = n_a
-    m_grid = np.linspace(0.01, a_max, n_m)  # wealth is always greater than 0
-
-    @njit
-    def u(c):
-        """Utility function."""
-        return np.log(c)
-
-    @njit
-    def u_prime(c):
-        """Derivative of utility function."""
-        return 1 / c
-
-    @njit
-    def u_prime_inv(u):
-        """Inverse of derivative of utility function."""
-        return 1 / u
-
-    @njit
-    def egm_step(p_c0):
-        """Iterate policy function based on FOC and envelop condition.
-
-        Parameters
-        ----------
-        p_c0 : initial consumption policy on (m, y) grids.
-
-        Returns
-        -------
-        p_c1 : updated consumption policy on (m, y) grids.
-        """
-        # m' on (a, y) grids
-        m1_grid = (1 + r) * a_grid.reshape(-1, 1) + y_grid.reshape(1, -1)
-
-        # c(m', y) on (a, y) grids
-        c1_grid = np.empty((n_a, n_y))
-        for i in range(n_y):
-            c1_grid[:, i] = np.interp(m1_grid[:, i], m_grid, p_c0[:, i])
-
-        # E[u'(c(m', y))] on (a, y) grids
-        ex_u_prime_grid = np.empty((n_a, n_y))
-        for i in range(n_a):
-            for j in range(n_y):
-                ex_u_prime_grid[i, j] = np.dot(Π_y[j, :], u_prime(c1_grid[i, :]))
-
-        # updated consumption policy on (a, y) grids
-        c0_grid = u_prime_inv(β * (1 + r) * ex_u_prime_grid)
-
-        # endogenous (m, y) grid
-        m_y_grid = a_grid.reshape(-1, 1) + c0_grid
-
-        # updated consumption policy on (m, y) grids
-        p_c1 = np.empty((n_m, n_y))
-        for i in range(n_y):
-            # handle corner solution (borrowing constraint: consumption cannot exceed wealth)
-            p_c1[:, i] = np.minimum(
-                np.interp(m_grid, m_y_grid[:, i], c0_grid[:, i]), m_grid
-            )
-
-        return p_c1
+    model = household(β, r, a_min, a_max, n_a, ρ, σ, n_y)
+    y_grid, m_grid = model.y_grid, model.m_grid
 
-    @njit
-    def egm(max_iter=10_000_000, tol=1e-9, details=False):
-        """Solve the consumption policy function using EGM.
+    def egm(max_iter=10_000_000, tol=1e-9, details=False, **options):
+        """Solve the consumption policy function using EGM (options of `solve_egm`)."""
+        return solve_egm(model, max_iter, tol, details, parallel=parallel, **options)
 
-        Parameters
-        ----------
-        tol: tolerance for convergence.
-        max_iter: maximum number of iterations.
-
-        Returns
-        -------
-        p_c: nz * na grids of consumption policy function.
-        a_prime: nz * na grids of next period asset policy function.
-        """
-        # initial guess of consumption policy (consume 50% of wealth)
-        p_c0 = 0.5 * m_grid.repeat(n_y).reshape(n_m, n_y)
-        # iterate until convergence
-        for i in range(max_iter):
-            p_c1 = egm_step(p_c0)
-            if np.max(np.abs(p_c1 - p_c0)) < tol:
-                print(f"Converged in {i+1} iterations.") if details == True else None
-                return p_c1
-            else:
-                p_c0 = p_c1
-        else:
-            raise ValueError("No converge.")
+    egm.model = model
 
     def draw_policy(p_c, y_index_list, m_index_list):
         """Draw 3-D policy function, and 2-D consumption policy function for given income levels.
         p_c: consumption policy function on (m, y) grids.
         """
+        import matplotlib as mpl
+        import matplotlib.pyplot as plt
 
         # Set up a figure half as tall as it is wide
         fig = plt.figure(figsize=plt.figaspect(0.5))
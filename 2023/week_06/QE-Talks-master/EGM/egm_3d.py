@@ -1,12 +1,71 @@
 """
 3D EGM algorithm for solving the consumption-savings-working-studying problem.
 """
+import time
+from concurrent.futures import ThreadPoolExecutor
+
 import numpy as np
-import matplotlib as mpl
-import matplotlib.pyplot as plt
 from numba import njit
-from scipy.interpolate import Rbf
-from ar1 import discretization_ar1
+import accel
+import interpolation as interpolation_backends
+from checkpoint import load_checkpoint, save_checkpoint
+from ar1 import cached_discretization_ar1
+
+
+@njit(cache=True)
+def recover_states(choices, F, w_grid, a1, a2, b1, b2):
+    """generates endogenous states given post decision states and the choices on them.
+
+    choices: N * 3 choices (h0, l0, c0).
+    F: N * 4 post decision states (w0 index, e1, q1, a0).
+
+    Returns
+    -------
+    N * 4 endogenous states (w0, e0, q0, m0).
+    """
+    X1 = np.empty((F.shape[0], 4))
+    for i in range(F.shape[0]):
+        X1[i, 0] = w_grid[int(F[i, 0])]
+        X1[i, 1] = (F[i, 1] - a2 * choices[i, 0]) / a1
+        X1[i, 2] = (F[i, 2] - b2 * choices[i, 1]) / b1
+        X1[i, 3] = F[i, 3] + choices[i, 2]
+    return X1
+
+
+def evaluate_policy(policy, x, block=4096, pool=None):
+    """Choices of policy on the rows (w, e, q, m) of x, as an n * 3 array.
+
+    Points are evaluated in blocks of `block` rows, which bounds the memory of
+    backends building a points-by-nodes matrix (the global Rbf). With a pool,
+    the blocks are evaluated by its threads, which all share policy. policy may
+    return an array with a trailing axis of length 3 or a tuple (h, l, c).
+    """
+
+    def f(x):
+        y = policy(*x.T)
+        if isinstance(y, tuple):
+            y = np.stack(np.broadcast_arrays(*y), axis=-1)
+        return np.reshape(y, (-1, 3))
+
+    blocks = [x[i : i + block] for i in range(0, len(x), block)]
+    return np.concatenate(list(map(f, blocks) if pool is None else pool.map(f, blocks)))
+
+
+_pools = {}  # n_workers -> thread pool, kept for the life of the process
+
+
+def thread_pool(n_workers):
+    """Persistent pool of n_workers threads (None for serial execution)."""
+    if n_workers <= 1:
+        return None
+    if n_workers not in _pools:
+        _pools[n_workers] = ThreadPoolExecutor(n_workers)
+    return _pools[n_workers]
+
+
+def _block(n, n_workers, block=4096):
+    # blocks of at most `block` points, at least one per worker
+    return max(1, min(block, -(-n // n_workers)))
 
 
 # 1. EGM algorithm for solving the consumption-savings problem.
@@ -32,6 +91,8 @@ def egm3d_factory(
     b1=0.3,
     b2=1,
     γ=0.5,
+    interpolation="rbf",
+    interpolation_options=None,
 ):
     """Factory of functions for the household problem.
 
@@ -51,17 +112,22 @@ def egm3d_factory(
     ρ: AR(1) coefficient for log income.
     σ: standard deviation of log income.
     n_w: number of points in income grid.
+    interpolation: backend fitting the policy function to the endogenous points,
+        "rbf" (global Rbf), "local_rbf" (KD-tree neighborhoods) or "grid"
+        (reprojection onto the state grid); see `interpolation.py`.
+    interpolation_options: keyword arguments of the backend (e.g. {"neighbors": 32}).
 
     Returns:
     --------
     egm: EGM solver for household's consumption policy function.
     draw_plot: a function which draws 2-d plots of the policy functions.
     """
+    params = dict(locals())  # for the coarse problems of grid continuation
     # discretize AR(1) process for income
     # log_y_grid: grid points for log income
     # Π_y: transition matrix for income
     # π_y: stationary distribution for income
-    log_w_grid, Π_w, π_w = discretization_ar1(ρ, σ, n_w)
+    log_w_grid, Π_w, π_w = cached_discretization_ar1(ρ, σ, n_w)
     w_grid = np.exp(log_w_grid)  # labor supply grid
 
     # next period experience grid
@@ -78,20 +144,22 @@ def egm3d_factory(
     m_grid = np.linspace(a_min, a_max, n_m)  # wealth is always greater than 0
 
     # states grids
-    X = np.array(
-        [[w, e, q, m] for w in w_grid for e in e_grid for q in q_grid for m in m_grid]
-    )
+    X = np.stack(np.meshgrid(w_grid, e_grid, q_grid, m_grid, indexing="ij"), axis=-1).reshape(-1, 4)
 
     # post decision states grids (reach row is one observation 1*4 vector)
-    F = np.array(
-        [
-            [w_i, e, q, a]
-            for w_i in range(n_w)
-            for e in e_grid
-            for q in q_grid
-            for a in a_grid
-        ]
-    )
+    F = np.stack(
+        np.meshgrid(np.arange(n_w, dtype=np.float64), e_grid, q_grid, a_grid, indexing="ij"),
+        axis=-1,
+    ).reshape(-1, 4)
+
+    # next period states (w1, e1, q1, m1) of every post decision state (rows) and
+    # income level w1 (columns), and the transition probabilities to them
+    w0_index = F[:, 0].astype(np.int64)
+    e1, q1, a0 = F[:, 1:2], F[:, 2:3], F[:, 3:4]
+    w1 = w_grid[None, :]
+    m1 = (1 + r) * a0 + w1 * (e1 ** (1 - γ)) * (q1**γ)
+    X1_next = np.stack(np.broadcast_arrays(w1, e1, q1, m1), axis=-1).reshape(-1, 4)
+    Π_F = Π_w[w0_index]
 
     # define marginal utility functions
 
@@ -140,68 +208,208 @@ def egm3d_factory(
         """partial derivative of M_{t+1} w.r.t. Q_{t+1}."""
         return w * γ * (e / q) ** (1 - γ)
 
-    def euler(w0_index, e1, q1, a0, policy):
-        """get choice h0, l0, c0 given post decision states.
-        policy: 2d grids represents a function of (e, q, m) -> (h, l, c),
-        rows are observations, columns are choices (h, l, c).
+    def euler(policy, n_workers=1):
+        """get choices h0, l0, c0 on all post decision states F.
+        policy: function (w, e, q, m) -> (h, l, c), evaluated once on the next period
+        states of every post decision state and income level.
+        n_workers: number of threads evaluating policy, on chunks of consecutive
+        post decision states (F is ordered by income state w0).
         """
-        rhs1, rhs2, rhs3 = 0.0, 0.0, 0.0
-
-        for w1, π in zip(w_grid, Π_w[w0_index]):
-            m1 = (1 + r) * a0 + w1 * (e1 ** (1 - γ)) * (q1**γ)
-            h1, l1, c1 = policy(w1, e1, q1, m1)
-            rhs1 += β * a2 * π * (L1(h1, l1, c1) + g1(w1, e1, q1) * L3(h1, l1, c1))
-            rhs2 += β * b2 * π * (L2(h1, l1, c1) + g2(w1, e1, q1) * L3(h1, l1, c1))
-            rhs3 += β * π * (-1) * (1 + r) * L3(h1, l1, c1)
-        h0, l0, c0 = u1_prime_inv(rhs1), u2_prime_inv(rhs2), u3_prime_inv(rhs3)
-        h0, l0, c0 = np.maximum(
-            [u1_prime_inv(rhs1), u2_prime_inv(rhs2), u3_prime_inv(rhs3)],
-            [0.0, 0.0, 0.0],
+        y1 = evaluate_policy(
+            policy, X1_next, _block(len(X1_next), n_workers), thread_pool(n_workers)
+        )
+        h1, l1, c1 = np.moveaxis(y1.reshape(len(F), n_w, 3), -1, 0)
+        L3_1 = L3(h1, l1, c1)
+        terms = np.stack(
+            [
+                β * a2 * (L1(h1, l1, c1) + g1(w1, e1, q1) * L3_1),
+                β * b2 * (L2(h1, l1, c1) + g2(w1, e1, q1) * L3_1),
+                β * (-1) * (1 + r) * L3_1,
+            ]
+        )
+        # expectation over w1: contract the income axis with the transition rows
+        rhs1, rhs2, rhs3 = np.einsum("kiw,iw->ki", terms, Π_F)
+        return np.maximum(
+            np.column_stack([u1_prime_inv(rhs1), u2_prime_inv(rhs2), u3_prime_inv(rhs3)]),
+            0.0,
+        )
+
+    def euler_step(policy0, n_workers=1):
+        """choices on the post decision states and the endogenous states they imply."""
+        choices = euler(policy0, n_workers)
+        return choices_states(choices), choices
+
+    def fit_policy(X1, choices):
+        """policy function interpolating choices on the endogenous states X1"""
+        return interpolation_backends.fit_policy(
+            X1,
+            choices,
+            interpolation,
+            grid=(w_grid, e_grid, q_grid, m_grid),
+            **(interpolation_options or {}),
         )
-        return h0, l0, c0
-
-    def recover_states(h0, l0, c0, e1, q1, a0):
-        """generates endogenous states given post decision states give policy function."""
-        e0 = (e1 - a2 * h0) / a1
-        q0 = (q1 - b2 * l0) / b1
-        m0 = a0 + c0
-        return e0, q0, m0
-
-    def egm_step(policy0):
-        """update policy functions"""
-        X1 = np.empty_like(X)  # endogenous states
-        choices = np.empty(
-            (n_w * n_e * n_q * n_a, 3)
-        )  # choices on the endogenous states
-        for i, (w0_index, e1, q1, a0) in enumerate(F):  # loop over post decision states
-            w0_index = int(w0_index)
-            h0, l0, c0 = euler(w0_index, e1, q1, a0, policy0)
-            e0, q0, m0 = recover_states(h0, l0, c0, e1, q1, a0)
-            X1[i] = w_grid[w0_index], e0, q0, m0
-            choices[i] = h0, l0, c0
-        # update policy function (inaccurate interpolation for small number of points!!)
-        policy1 = Rbf(*X1.T, choices, mode="N-D")
-
-        return policy1
-
-    def egm_3d(tol=1e-6, max_iter=10_000, details=False):
-        """update policy functions"""
-        policy0 = lambda w, e, q, m: (0.01 * e, 0.01 * q, 0.5 * m)
-        for i in range(max_iter):
+
+    def choices_states(choices):
+        """endogenous states implied by choices on the post decision states F (as in euler_step)."""
+        return recover_states(choices, F, w_grid, a1, a2, b1, b2)
+
+    def choices_policy(choices):
+        """policy function implied by choices on the post decision states F."""
+        return fit_policy(choices_states(choices), choices)
+
+    def egm_3d(
+        tol=1e-6,
+        max_iter=10_000,
+        details=False,
+        method="fixed_point",
+        memory=5,
+        return_info=False,
+        policy0=None,
+        grid_levels=None,
+        checkpoint=None,
+        checkpoint_every=10,
+        n_workers=1,
+    ):
+        """update policy functions
+
+        method: "fixed_point" (successive approximation of the policy function),
+            "anderson" (Anderson mixing of the last `memory` iterates) or "newton_krylov".
+            The accelerated methods solve for the choices on the post decision states,
+            which determine the policy function (tol then applies to these choices),
+            and fall back to successive approximation when they fail. They are not
+            reliably faster here: the projection onto nonnegative choices makes the
+            operator kinked, so Anderson restarts often and Newton-Krylov may end in
+            its fallback.
+        return_info: also return a dict with the method, the iteration count and the time.
+        policy0: initial policy function (w, e, q, m) -> (h, l, c).
+        grid_levels: increasing (n_e, n_q, n_a) sizes of coarser problems. Each level is
+            solved from the policy of the previous one, and the last level's policy
+            is the initial guess on this grid (only the solve on this grid is checkpointed).
+        checkpoint: optional directory of a checkpoint (see `checkpoint.py`) holding the
+            endogenous states X1 and the choices on them, which define the policy. The
+            solve resumes from it, or returns its policy if that run converged with the
+            same tolerance; successive approximation saves every `checkpoint_every`
+            iterations, and every method saves its solution.
+        n_workers: number of threads of a persistent pool evaluating the policy in the
+            Euler step and in the convergence check (1 for serial execution). The
+            threads share the current policy; they run concurrently where the
+            interpolation backend releases the GIL (distance and matrix products of
+            "rbf", the compiled queries of "grid").
+        """
+        i0 = 0  # iterations of the run that wrote the checkpoint
+        if checkpoint is not None:
+            saved = load_checkpoint(checkpoint, mmap_mode=None)
+            if saved is not None:
+                arrays, state = saved
+                if state["params"] != params:
+                    raise ValueError(f"The checkpoint in {checkpoint} is of another model.")
+                policy0 = fit_policy(arrays["X1"], arrays["choices"])
+                i0, grid_levels = state["iterations"], None
+                if state["converged"] and state["tol"] <= tol:
+                    info = {
+                        "method": "checkpoint",
+                        "iterations": i0,
+                        "time": 0.0,
+                        "converged": True,
+                    }
+                    return (policy0, info) if return_info else policy0
+
+            def save(X1, choices, iterations, converged):
+                save_checkpoint(
+                    checkpoint, {"X1": X1, "choices": choices}, params=params, tol=tol,
+                    iterations=iterations, converged=converged,
+                )
+
+        if grid_levels:
+            # grid continuation: solve coarse problems first and warm start from them
+            t0 = time.perf_counter()
+            options = dict(
+                tol=tol, max_iter=max_iter, method=method, memory=memory, n_workers=n_workers
+            )
+            levels = []
+            for n_e_, n_q_, n_a_ in grid_levels:
+                egm_3d_, _ = egm3d_factory(**{**params, "n_e": n_e_, "n_q": n_q_, "n_a": n_a_})
+                result = egm_3d_(**options, return_info=True, policy0=policy0)
+                if result is None:  # no convergence on a coarse level
+                    return
+                policy0, info = result
+                levels.append(info)
+            result = egm_3d(
+                **options, details=details, return_info=True, policy0=policy0,
+                checkpoint=checkpoint, checkpoint_every=checkpoint_every,
+            )
+            if result is None:
+                return
+            policy, info = result
+            info["levels"] = levels
+            info["time"] = time.perf_counter() - t0
+            return (policy, info) if return_info else policy
+
+        if policy0 is None:
+            policy0 = lambda w, e, q, m: np.stack(
+                np.broadcast_arrays(0.01 * e, 0.01 * q, 0.5 * m), axis=-1
+            )
+        if method != "fixed_point":
+
+            def T(choices):
+                # project extrapolated guesses onto feasible choices (h, l >= 0, c > 0)
+                choices = np.maximum(choices, [0.0, 0.0, 1e-12])
+                return euler_step(choices_policy(choices), n_workers)[1]
+
+            choices0 = euler_step(policy0, n_workers)[1]
+            if method == "anderson":
+                choices, info = accel.anderson(T, choices0, tol, max_iter, memory=memory)
+            elif method == "newton_krylov":
+                choices, info = accel.newton_krylov(T, choices0, tol)
+            else:
+                raise ValueError(f"Unknown method: {method}")
+            info["iterations"] += 1  # the step from the initial guess
+            if not info["converged"]:
+                print("No convergence.")
+                return
+            print(info) if details else None
+            if checkpoint is not None:
+                save(choices_states(choices), choices, i0 + info["iterations"], True)
+            policy = choices_policy(choices)
+            return (policy, info) if return_info else policy
+
+        t0 = time.perf_counter()
+        for i in range(i0, max_iter):
             print(i) if details else None
-            policy1 = egm_step(policy0)
+            X1, choices = euler_step(policy0, n_workers)
+            policy1 = fit_policy(X1, choices)
             if i >= 1:
                 # we use consumption policy as convergence criteria
-                diff = np.max(np.abs(policy1(*X.T) - policy0(*X.T)))
+                block, pool = _block(len(X), n_workers), thread_pool(n_workers)
+                diff = np.max(
+                    np.abs(
+                        evaluate_policy(policy1, X, block, pool)
+                        - evaluate_policy(policy0, X, block, pool)
+                    )
+                )
                 if diff < tol:
-                    return policy1
+                    info = {
+                        "method": "fixed_point",
+                        "iterations": i + 1 - i0,
+                        "time": time.perf_counter() - t0,
+                        "converged": True,
+                    }
+                    if checkpoint is not None:
+                        save(X1, choices, i + 1, True)
+                    return (policy1, info) if return_info else policy1
                 else:
                     print(diff) if details else None
+            if checkpoint is not None and (i + 1) % checkpoint_every == 0:
+                save(X1, choices, i + 1, False)
             policy0 = policy1
         else:
+            if checkpoint is not None and max_iter > i0:
+                save(X1, choices, max_iter, False)
             print("No convergence.")
 
     def egm_3d_plot(policy, m_list=np.linspace(0.1, 10, 100)):
+        import matplotlib.pyplot as plt
+
         fig, (ax1, ax2, ax3) = plt.subplots(1, 3, figsize=(18, 4))
         ax1.set_xlabel("M")
         ax2.set_xlabel("M")
@@ -235,6 +443,7 @@ def egm3d_factory(
         ax3.legend()
         plt.show()
 
+    egm_3d.euler_step = euler_step  # one step from a policy function (for benchmarks)
     return egm_3d, egm_3d_plot
 
 
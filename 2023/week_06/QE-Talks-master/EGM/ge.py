@@ -0,0 +1,98 @@
+"""
+General equilibrium of the 1D household problem: the interest rate that clears the asset market.
+"""
+import time
+
+from distribution import stationary_wealth
+from egm_1d import household, solve_egm
+
+
+def capital_demand(r, α=0.36, δ=0.08, L=1.0):
+    """Capital demand of a Cobb-Douglas firm, from r = α K^(α-1) L^(1-α) - δ."""
+    return L * (α / (r + δ)) ** (1 / (1 - α))
+
+
+def ge_interest_rate(
+    asset_supply,
+    r_low,
+    r_high,
+    tol=1e-8,
+    egm_tol=1e-9,
+    method="fixed_point",
+    details=False,
+    **params,
+):
+    """Interest rate at which households' stationary assets equal asset_supply(r).
+
+    Brent's method brackets the root of the excess demand A(r) - asset_supply(r).
+    Every evaluation solves the household problem with `solve_egm` and its
+    stationary distribution with `stationary_wealth`, both warm started from the
+    solution at the nearest interest rate evaluated so far. The kernels are
+    compiled once and the income process comes from the discretization cache, so
+    evaluations after the first pay for solving only.
+
+    Parameters
+    ----------
+    asset_supply: function of r giving the supply of assets (e.g. `capital_demand`).
+    r_low, r_high: bracket of the equilibrium interest rate (r_high < 1/β - 1).
+    tol: tolerance on r.
+    egm_tol: tolerance of the household solver.
+    method: method of `solve_egm`.
+    details: print a line per evaluation and a summary.
+    params: other parameters of `household` (β, a_max, n_a, ρ, σ, n_y, ...).
+
+    Returns
+    -------
+    r: equilibrium interest rate.
+    p_c: consumption policy at r.
+    D: stationary distribution at r.
+    log: list of dicts with r, A, supply, iterations and time of each evaluation.
+    """
+    from scipy.optimize import brentq
+
+    t0 = time.perf_counter()
+    solutions = {}  # r -> (p_c, D)
+    log = []
+
+    def excess_demand(r):
+        t = time.perf_counter()
+        model = household(r=r, **params)
+        p_c0 = D0 = None
+        if solutions:
+            p_c0, D0 = solutions[min(solutions, key=lambda r0: abs(r0 - r))]
+        p_c, info = solve_egm(model, tol=egm_tol, method=method, return_info=True, p_c0=p_c0)
+        D, A, _ = stationary_wealth(model, p_c, D0=D0)
+        solutions[r] = (p_c, D)
+        log.append(
+            {
+                "r": r,
+                "A": A,
+                "supply": asset_supply(r),
+                "iterations": info["iterations"],
+                "time": time.perf_counter() - t,
+            }
+        )
+        if details == True:
+            entry = log[-1]
+            print(
+                f"r = {r:.8f}: A = {A:.6f}, supply = {entry['supply']:.6f} "
+                f"({entry['iterations']} EGM iterations, {entry['time']:.3f} s)"
+            )
+        return A - asset_supply(r)
+
+    r = brentq(excess_demand, r_low, r_high, xtol=tol)
+    if r not in solutions:
+        excess_demand(r)
+    p_c, D = solutions[r]
+    if details == True:
+        print(
+            f"Equilibrium r = {r:.8f} after {len(log)} evaluations "
+            f"({time.perf_counter() - t0:.3f} s)."
+        )
+    return r, p_c, D, log
+
+
+if __name__ == "__main__":
+    r, p_c, D, log = ge_interest_rate(
+        capital_demand, -0.01, 0.019, n_a=500, σ=0.7, details=True
+    )
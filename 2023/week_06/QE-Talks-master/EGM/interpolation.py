@@ -0,0 +1,165 @@
+"""
+Interpolation backends for the policy functions of the 3D EGM.
+
+A backend fits the choices (h, l, c) observed at the scattered endogenous
+states X1 (rows (w, e, q, m)) and returns the policy function
+(w, e, q, m) -> (h, l, c). Arguments broadcast against each other, and the
+result has a trailing axis of length 3, so a scalar query unpacks as h, l, c.
+
+- "rbf": global radial basis function (scipy.interpolate.Rbf), the original
+  interpolation; fitting is a dense O(N^3) solve and each query costs O(N).
+- "local_rbf": RBF on the k nearest neighbors of each query, found with a
+  KD-tree (scipy.interpolate.RBFInterpolator); fitting builds the tree in
+  O(N log N) and each query costs O(log N + k^3).
+- "grid": the choices are reprojected once onto the regular state grid by
+  piecewise-linear interpolation on a Delaunay triangulation of each income
+  level (nearest neighbor outside the convex hull), and queries are
+  multilinear on that grid (compiled) in O(log N).
+"""
+import numpy as np
+from numba import njit
+
+
+class Policy:
+    """Policy function (w, e, q, m) -> (h, l, c) evaluating f on rows of states."""
+
+    def __init__(self, f):
+        self.f = f
+
+    def __call__(self, w, e, q, m):
+        x = np.stack(np.broadcast_arrays(w, e, q, m), axis=-1).astype(np.float64)
+        return self.f(x.reshape(-1, 4)).reshape(x.shape[:-1] + (3,))
+
+
+def fit_rbf(X1, choices, grid=None):
+    """Global RBF through all points (the original `Rbf(*X1.T, choices, mode="N-D")`)."""
+    from scipy.interpolate import Rbf
+
+    return Rbf(*X1.T, choices, mode="N-D")
+
+
+def fit_local_rbf(X1, choices, grid, neighbors=32, kernel="thin_plate_spline", degree=1):
+    """RBF on the `neighbors` nearest points of each query (KD-tree neighborhoods).
+
+    One interpolator is fitted in (e, q, m) per income level of grid[0] (the
+    levels of X1), and queries are linear in w between adjacent levels.
+    """
+    from scipy.interpolate import RBFInterpolator
+
+    w_grid = np.asarray(grid[0], dtype=np.float64)
+    fits = []
+    for w in w_grid:
+        rows = X1[:, 0] == w
+        fits.append(
+            RBFInterpolator(
+                X1[rows, 1:],
+                choices[rows],
+                neighbors=min(neighbors, int(rows.sum())),
+                kernel=kernel,
+                degree=degree,
+            )
+        )
+
+    def f(x):
+        j = np.clip(np.searchsorted(w_grid, x[:, 0], side="right") - 1, 0, len(w_grid) - 2)
+        t = ((x[:, 0] - w_grid[j]) / (w_grid[j + 1] - w_grid[j])).reshape(-1, 1)
+        out = np.empty((len(x), 3))
+        for level in np.unique(j):
+            rows = j == level
+            y0 = fits[level](x[rows, 1:])
+            y1 = fits[level + 1](x[rows, 1:])
+            out[rows] = (1 - t[rows]) * y0 + t[rows] * y1
+        return out
+
+    return Policy(f)
+
+
+def fit_grid(X1, choices, grid):
+    """Reproject the choices onto the regular grid (w, e, q, m) and interpolate on it.
+
+    grid: tuple of the increasing axes (w_grid, e_grid, q_grid, m_grid). X1 must
+    hold states at the levels of w_grid only (as the EGM endogenous states do).
+    """
+    from scipy.interpolate import LinearNDInterpolator, NearestNDInterpolator
+
+    w_grid = grid[0]
+    shape = tuple(len(axis) for axis in grid)
+    values = np.empty(shape + (3,))
+    # (e, q, m) nodes of one income level
+    nodes = np.stack(np.meshgrid(*grid[1:], indexing="ij"), axis=-1).reshape(-1, 3)
+    for i, w in enumerate(w_grid):
+        rows = X1[:, 0] == w
+        points, y = X1[rows, 1:], choices[rows]
+        v = LinearNDInterpolator(points, y)(nodes)
+        outside = np.isnan(v).any(axis=1)
+        if outside.any():
+            v[outside] = NearestNDInterpolator(points, y)(nodes[outside])
+        values[i] = v.reshape(shape[1:] + (3,))
+
+    grid = tuple(np.ascontiguousarray(axis, dtype=np.float64) for axis in grid)
+    return Policy(lambda x: multilinear(grid, values, x))
+
+
+@njit(cache=True, nogil=True)
+def multilinear(grid, values, x):
+    """Multilinear interpolation (linear extrapolation) of values on a regular 4D grid.
+
+    grid: axes of the grid (each of length >= 2).
+    values: array of shape (len(axis) for axis in grid) + (k,).
+    x: n * 4 query points.
+
+    Returns
+    -------
+    n * k interpolated values.
+    """
+    n, k = x.shape[0], values.shape[-1]
+    out = np.zeros((n, k))
+    idx = np.empty(4, dtype=np.int64)
+    t = np.empty(4)
+    for p in range(n):
+        for d in range(4):
+            axis = grid[d]
+            j = min(max(np.searchsorted(axis, x[p, d], side="right") - 1, 0), axis.shape[0] - 2)
+            idx[d] = j
+            t[d] = (x[p, d] - axis[j]) / (axis[j + 1] - axis[j])
+        for corner in range(16):
+            weight = 1.0
+            for d in range(4):
+                if (corner >> d) & 1:
+                    weight *= t[d]
+                else:
+                    weight *= 1 - t[d]
+            i0 = idx[0] + (corner & 1)
+            i1 = idx[1] + ((corner >> 1) & 1)
+            i2 = idx[2] + ((corner >> 2) & 1)
+            i3 = idx[3] + ((corner >> 3) & 1)
+            for c in range(k):
+                out[p, c] += weight * values[i0, i1, i2, i3, c]
+    return out
+
+
+BACKENDS = {
+    "rbf": fit_rbf,
+    "local_rbf": fit_local_rbf,
+    "grid": fit_grid,
+}
+
+
+def fit_policy(X1, choices, method="rbf", grid=None, **options):
+    """Fit the policy function through choices at the endogenous states X1.
+
+    Parameters
+    ----------
+    X1: N * 4 endogenous states (w, e, q, m).
+    choices: N * 3 choices (h, l, c) at X1.
+    method: "rbf", "local_rbf" or "grid" (see the module docstring).
+    grid: axes (w_grid, e_grid, q_grid, m_grid) of the regular state grid ("grid" only).
+    options: keyword arguments of the backend (e.g. neighbors for "local_rbf").
+
+    Returns
+    -------
+    policy: function (w, e, q, m) -> (h, l, c).
+    """
+    if method not in BACKENDS:
+        raise ValueError(f"Unknown interpolation: {method}")
+    return BACKENDS[method](X1, choices, grid, **options)
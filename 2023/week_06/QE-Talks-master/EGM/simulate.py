@@ -0,0 +1,169 @@
+"""
+Monte Carlo simulation of households following a 1D EGM policy.
+
+Agents are advanced in parallel and cross-sectional statistics are accumulated
+period by period, so the N * T panel is never stored (unless a history file is
+requested). Income draws use the counter-based streams of `ar1`: agent i draws
+from stream (seed, i) with counter t, so the income paths equal
+`ar1.simulate_markov(Π_y, π_y, N, T, seed)` and do not depend on the number of threads.
+"""
+import numpy as np
+from numba import njit, prange
+from ar1 import counter_uniform, markov_cdf, stationary_distribution
+
+
+@njit(parallel=True, cache=True)
+def initial_states(cdf0, y_grid, r, a0, seed, m, s):
+    """Draw period-0 income states from cdf0 and set m = (1 + r) a0 + y, in place."""
+    for i in prange(m.shape[0]):
+        s[i] = np.searchsorted(cdf0, counter_uniform(seed, i, 0), side="right")
+        m[i] = (1 + r) * a0[i] + y_grid[s[i]]
+
+
+@njit(parallel=True, cache=True)
+def simulate_period(
+    p_c_T, m_grid, y_grid, cdf, r, t, seed, m, s, width, counts, sums, c_sums, m_out
+):
+    """Record period t of every agent and advance it to period t + 1, in place.
+
+    Agents are split into counts.shape[0] fixed chunks with their own
+    accumulators, so the statistics do not depend on the number of threads.
+
+    Parameters
+    ----------
+    p_c_T: consumption policy, one row per income state (n_y * n_m).
+    m_grid, y_grid: wealth and income grids.
+    cdf: cumulative rows of Π_y (see `markov_cdf`).
+    r: net interest rate.
+    t: current period.
+    seed: seed of the income streams.
+    m, s: wealth and income state of each agent at t, overwritten with t + 1.
+    width: width of the wealth histogram bins (the last bin is open ended).
+    counts, sums: n_chunks * n_bins histograms of agents and of their wealth at t.
+    c_sums: n_chunks sums of consumption at t.
+    m_out: length-N array receiving wealth at t (or an empty array).
+    """
+    N = m.shape[0]
+    n_m = m_grid.shape[0]
+    n_chunks, n_bins = counts.shape
+    for q in prange(n_chunks):
+        counts[q] = 0.0
+        sums[q] = 0.0
+        c_sums[q] = 0.0
+        for i in range(q * N // n_chunks, (q + 1) * N // n_chunks):
+            m_i, s_i = m[i], s[i]
+            # c(m, y) by linear interpolation, flat outside m_grid (as np.interp)
+            j = min(max(np.searchsorted(m_grid, m_i, side="right") - 1, 0), n_m - 2)
+            w = min(max((m_i - m_grid[j]) / (m_grid[j + 1] - m_grid[j]), 0.0), 1.0)
+            c_i = (1 - w) * p_c_T[s_i, j] + w * p_c_T[s_i, j + 1]
+            b = min(int(m_i / width), n_bins - 1)
+            counts[q, b] += 1.0
+            sums[q, b] += m_i
+            c_sums[q] += c_i
+            if m_out.shape[0] > 0:
+                m_out[i] = m_i
+            s_i = np.searchsorted(cdf[s_i], counter_uniform(seed, i, t + 1), side="right")
+            m[i] = (1 + r) * (m_i - c_i) + y_grid[s_i]
+            s[i] = s_i
+
+
+def histogram_quantiles(counts, width, quantiles):
+    """Quantiles of a histogram with bins [k * width, (k + 1) * width), uniform within bins."""
+    cum = np.concatenate(([0.0], np.cumsum(counts))) / counts.sum()
+    edges = width * np.arange(len(counts) + 1)
+    return np.interp(quantiles, cum, edges)
+
+
+def histogram_gini(counts, sums):
+    """Gini coefficient of the Lorenz curve through the bins (within-bin inequality ignored)."""
+    f = counts / counts.sum()
+    L = np.concatenate(([0.0], np.cumsum(sums))) / sums.sum()
+    return 1.0 - np.sum(f * (L[:-1] + L[1:]))
+
+
+def simulate_households(
+    p_c,
+    m_grid,
+    y_grid,
+    Π_y,
+    r,
+    N=1_000_000,
+    T=200,
+    seed=1234,
+    π_y=None,
+    a0=0.0,
+    quantiles=(0.1, 0.25, 0.5, 0.75, 0.9),
+    n_bins=4096,
+    n_chunks=64,
+    history=None,
+    chunk=100,
+):
+    """Simulate N households for T periods under the consumption policy p_c.
+
+    Parameters
+    ----------
+    p_c: consumption policy on (m, y) grids.
+    m_grid, y_grid, Π_y, r: grids, income transition matrix and interest rate of the model.
+    N: number of households.
+    T: number of periods.
+    seed: seed of the income streams.
+    π_y: distribution of period-0 income (stationary distribution of Π_y by default).
+    a0: initial assets, a scalar or a length-N array.
+    quantiles: wealth quantiles reported each period.
+    n_bins: number of bins of the wealth histogram (the quantile and Gini sketch).
+    n_chunks: number of fixed agent chunks with separate accumulators.
+    history: optional path of a .npy file receiving the T * N wealth panel,
+        written in blocks of `chunk` periods through a memory map.
+    chunk: number of periods buffered before each write to history.
+
+    Returns
+    -------
+    stats: dict with, for each period, "mean_m", "mean_c", "mean_a" (end-of-period
+        assets), "gini_m" and "quantiles_m" (T * len(quantiles)), and the final
+        wealth "m" and income states "s" of the agents.
+    """
+    if π_y is None:
+        π_y, _ = stationary_distribution(Π_y)
+    p_c_T = np.ascontiguousarray(p_c.T)
+    cdf, cdf0 = markov_cdf(Π_y), markov_cdf(π_y)
+    m = np.empty(N)
+    s = np.empty(N, dtype=np.int32)
+    initial_states(cdf0, y_grid, r, np.broadcast_to(np.float64(a0), (N,)).copy(), seed, m, s)
+
+    # wealth never exceeds (1 + r) max(m_grid) + max(y_grid) unless a0 does
+    width = max((1 + r) * m_grid[-1] + y_grid.max(), m.max()) / n_bins
+    counts = np.empty((n_chunks, n_bins))
+    sums = np.empty((n_chunks, n_bins))
+    c_sums = np.empty(n_chunks)
+
+    if history is not None:
+        panel = np.lib.format.open_memmap(history, mode="w+", dtype=np.float64, shape=(T, N))
+        buffer = np.empty((min(chunk, T), N))
+    no_history = np.empty(0)
+
+    stats = {
+        "mean_m": np.empty(T),
+        "mean_c": np.empty(T),
+        "gini_m": np.empty(T),
+        "quantiles_m": np.empty((T, len(quantiles))),
+    }
+    for t in range(T):
+        m_out = buffer[t % chunk] if history is not None else no_history
+        simulate_period(
+            p_c_T, m_grid, y_grid, cdf, r, t, seed, m, s, width, counts, sums, c_sums, m_out
+        )
+        count, total = counts.sum(axis=0), sums.sum(axis=0)
+        stats["mean_m"][t] = total.sum() / N
+        stats["mean_c"][t] = c_sums.sum() / N
+        stats["gini_m"][t] = histogram_gini(count, total)
+        stats["quantiles_m"][t] = histogram_quantiles(count, width, quantiles)
+        if history is not None and (t % chunk == chunk - 1 or t == T - 1):
+            t0 = t - t % chunk
+            panel[t0 : t + 1] = buffer[: t + 1 - t0]
+    if history is not None:
+        panel.flush()
+        del panel
+
+    stats["mean_a"] = stats["mean_m"] - stats["mean_c"]
+    stats["m"], stats["s"] = m, s
+    return stats